@@ -1,52 +1,237 @@
+import asyncio
 import random
+import sys
 import time
-from threading import Condition, Semaphore, Thread, current_thread
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from queue import SimpleQueue
+from threading import Condition, Semaphore, Thread, active_count, current_thread
+
+
+class WorkerPool:
+    """Fixed set of long-lived threads pulling jobs off a shared queue."""
+
+    def __init__(self, max_workers, name="WorkerPool"):
+        self.jobs = SimpleQueue()
+        self.workers = [
+            Thread(name=f"{name}-{i}", target=self.run_worker, daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, fn, *args):
+        self.jobs.put((fn, args))
+
+    def run_worker(self):
+        while (job := self.jobs.get()) is not None:
+            fn, args = job
+            fn(*args)
+
+    def shutdown(self, wait=True):
+        # One sentinel per worker; each worker exits on the first one it sees
+        for _ in self.workers:
+            self.jobs.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
 
 
 class AsyncExecutor:
+    # max_workers=None keeps the original thread-per-call behaviour. latency_s is
+    # the (min, max) simulated work time in seconds; None skips the sleep entirely.
+    def __init__(self, max_workers=None, latency_s=(1, 5)):
+        self.latency_s = latency_s
+        self.pool = (
+            None
+            if max_workers is None
+            else WorkerPool(max_workers, name=f"AsyncExecutor-{id(self)}")
+        )
+
     def execute(self, callback):
-        Thread(name=f"AsyncExecutor-{id(self)}", target=self.work, args=(callback,)).start()
+        future = Future()
+        if self.pool is None:
+            Thread(
+                name=f"AsyncExecutor-{id(self)}", target=self.run, args=(callback, future)
+            ).start()
+        else:
+            self.pool.submit(self.run, callback, future)
+        return future
+
+    def execute_async(self, callback):
+        """Awaitable form of execute(); completion is handed back via call_soon_threadsafe."""
+        loop = asyncio.get_running_loop()
+        aio_future = loop.create_future()
+        # AsyncExecutor.execute explicitly: the sync subclasses' execute() would block the loop
+        future = AsyncExecutor.execute(self, callback)
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(transfer_state, future, aio_future)
+        )
+        aio_future.add_done_callback(lambda _: aio_future.cancelled() and future.cancel())
+        return aio_future
+
+    def run(self, callback, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.work(callback)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
 
     def work(self, callback):
-        time.sleep(random.randint(1, 5))
-        callback()
+        if self.latency_s is not None:
+            time.sleep(random.randint(*self.latency_s))
+        return callback()
+
+    def shutdown(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait)
+
+
+def deadline_after(timeout):
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def time_left(deadline):
+    return None if deadline is None else max(0, deadline - time.monotonic())
 
 
-class SyncExecutorSem(AsyncExecutor):
-    def __init__(self):
-        self.sem = Semaphore(0)
+def transfer_state(future, aio_future):
+    # Runs on the event loop thread, so touching the asyncio future is safe
+    if aio_future.cancelled():
+        return
+    if future.cancelled():
+        aio_future.cancel()
+    elif (exc := future.exception()) is not None:
+        aio_future.set_exception(exc)
+    else:
+        aio_future.set_result(future.result())
 
+
+class BackgroundLoop:
+    """One long-lived event loop on a daemon thread, for running coroutines from sync code."""
+
+    def __init__(self, name="BackgroundLoop"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(name=name, target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+# Placeholder in execute_many(partial=True) results for callbacks that didn't finish
+NOT_DONE = object()
+
+
+class SyncExecutor(AsyncExecutor, ABC):
+    def submit(self, callback):
+        # Non-blocking submission, for batching on top of the blocking execute()
+        return AsyncExecutor.execute(self, callback)
+
+    @abstractmethod
+    def completions(self, futures, timeout=None):
+        """Yield futures in the order they finish; raise TimeoutError at the deadline."""
+
+    def as_completed(self, callbacks, timeout=None):
+        # Submit eagerly so the batch is in flight before the caller starts iterating
+        futures = [self.submit(callback) for callback in callbacks]
+        return (future.result() for future in self.completions(futures, timeout))
+
+    def execute_many(self, callbacks, timeout=None, partial=False):
+        futures = [self.submit(callback) for callback in callbacks]
+        try:
+            for _ in self.completions(futures, timeout):
+                pass
+        except TimeoutError:
+            if not partial:
+                raise
+        finally:
+            # Anything still queued in the pool is abandoned
+            for future in futures:
+                future.cancel()
+        return [
+            future.result() if future.done() and not future.cancelled() else NOT_DONE
+            for future in futures
+        ]
+
+
+class SyncExecutorSem(SyncExecutor):
     def execute(self, callback):
-        super().execute(callback)
-        self.sem.acquire()
+        # A semaphore per call, so overlapping calls can't steal each other's release
+        sem = Semaphore(0)
+        future = super().execute(callback)
+        future.add_done_callback(lambda _: sem.release())
+        sem.acquire()
         print(f"[{current_thread().getName()}@{time.strftime('%T')}] finished executing.")
+        return future.result()
 
-    def work(self, callback):
-        super().work(callback)
-        self.sem.release()
+    def completions(self, futures, timeout=None):
+        # One release per finished future; deque appends/pops are thread-safe
+        sem = Semaphore(0)
+        done = deque()
+
+        def on_done(future):
+            done.append(future)
+            sem.release()
 
+        for future in futures:
+            future.add_done_callback(on_done)
+        deadline = deadline_after(timeout)
+        for remaining in range(len(futures), 0, -1):
+            if not sem.acquire(timeout=time_left(deadline)):
+                raise TimeoutError(f"{remaining} callbacks still pending")
+            yield done.popleft()
 
-class SyncExecutorCV(AsyncExecutor):
-    def __init__(self):
-        self.cv = Condition()
-        self.is_done = False
 
+class SyncExecutorCV(SyncExecutor):
     def execute(self, callback):
-        super().execute(callback)
-        with self.cv:
-            while not self.is_done:
-                self.cv.wait()
-            self.is_done = False
+        # Wait on this call's future rather than a flag shared by every caller
+        cv = Condition()
+        future = super().execute(callback)
+        future.add_done_callback(lambda _: self.notify(cv))
+        with cv:
+            while not future.done():
+                cv.wait()
         print(f"[{current_thread().getName()}@{time.strftime('%T')}] finished executing.")
+        return future.result()
 
-    def work(self, callback):
-        super().work(callback)
+    def notify(self, cv):
         print(
             f"[{current_thread().getName()}@{time.strftime('%T')}] finished work; notifying."
         )
-        with self.cv:
-            self.cv.notify_all()
-            self.is_done = True
+        with cv:
+            cv.notify_all()
+
+    def completions(self, futures, timeout=None):
+        cv = Condition()
+        done = deque()
+
+        def on_done(future):
+            with cv:
+                done.append(future)
+                cv.notify()
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        deadline = deadline_after(timeout)
+        for remaining in range(len(futures), 0, -1):
+            with cv:
+                if not cv.wait_for(lambda: done, timeout=time_left(deadline)):
+                    raise TimeoutError(f"{remaining} callbacks still pending")
+                future = done.popleft()
+            yield future
 
 
 def shout_fruit():
@@ -64,7 +249,100 @@ def test(executor):
     )
 
 
+def noop():
+    pass
+
+
+def calls_per_second(executor, n_calls):
+    start = time.perf_counter()
+    futures = [executor.execute(noop) for _ in range(n_calls)]
+    for future in futures:
+        future.result()
+    return n_calls / (time.perf_counter() - start)
+
+
+def nap():
+    time.sleep(0.005)
+
+
+def batch_wall_time(executor, batch_size):
+    # Baseline: one blocking call after another, without the per-call logging
+    start = time.perf_counter()
+    for _ in range(batch_size):
+        executor.submit(nap).result()
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    executor.execute_many([nap] * batch_size)
+    batched = time.perf_counter() - start
+    return sequential, batched
+
+
+def bench_batches():
+    for executor in (
+        SyncExecutorSem(max_workers=64, latency_s=None),
+        SyncExecutorCV(max_workers=64, latency_s=None),
+    ):
+        for batch_size in (10, 100, 1000):
+            sequential, batched = batch_wall_time(executor, batch_size)
+            print(
+                f"{executor.__class__.__name__:<16} batch={batch_size:<5} sequential={sequential:7.3f}s execute_many={batched:7.3f}s"
+            )
+        executor.shutdown()
+
+
+async def await_many(executor, n_calls):
+    return await asyncio.gather(*(executor.execute_async(nap) for _ in range(n_calls)))
+
+
+async def answer():
+    await asyncio.sleep(0)
+    return 42
+
+
+def bench_asyncio(n_calls=5000, max_workers=8):
+    executor = AsyncExecutor(max_workers=max_workers, latency_s=None)
+    start = time.perf_counter()
+    asyncio.run(await_many(executor, n_calls))
+    print(
+        f"awaited {n_calls} callbacks on {max_workers} workers in {time.perf_counter() - start:0.3f}s ({active_count()} threads alive)"
+    )
+    executor.shutdown()
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        asyncio.run(answer())
+    per_call = time.perf_counter() - start
+    bg_loop = BackgroundLoop()
+    start = time.perf_counter()
+    for _ in range(1000):
+        bg_loop.run(answer())
+    background = time.perf_counter() - start
+    bg_loop.stop()
+    print(
+        f"1000 coroutines from sync code: asyncio.run={per_call:0.3f}s BackgroundLoop={background:0.3f}s"
+    )
+
+
+def bench_calls(n_calls=20_000):
+    thread_per_call = AsyncExecutor(latency_s=None)
+    print(
+        f"{'thread-per-call':<18} {calls_per_second(thread_per_call, n_calls):>12,.0f} calls/s"
+    )
+    for max_workers in (1, 4, 16):
+        pooled = AsyncExecutor(max_workers=max_workers, latency_s=None)
+        print(
+            f"{f'pool({max_workers})':<18} {calls_per_second(pooled, n_calls):>12,.0f} calls/s"
+        )
+        pooled.shutdown()
+
+
 if __name__ == "__main__":
-    test(AsyncExecutor())
-    test(SyncExecutorSem())
-    test(SyncExecutorCV())
+    if sys.argv[1:] == ["bench"]:
+        bench_calls()
+        bench_batches()
+        bench_asyncio()
+    else:
+        test(AsyncExecutor())
+        test(SyncExecutorSem())
+        test(SyncExecutorCV(max_workers=2))
@@ -1,48 +1,283 @@
+import multiprocessing
 import random
+import sys
+import threading
 import time
-from threading import Condition, Thread, current_thread
+from multiprocessing.shared_memory import SharedMemory
+from threading import BrokenBarrierError, Condition, Lock, Thread, current_thread
+
+
+class Generation:
+    # Each generation gets its own Condition on the barrier's lock, so tripping
+    # one only wakes the threads that arrived for it.
+    def __init__(self, lock):
+        self.cv = Condition(lock)
+        self.tripped = False
+        self.broken = False
+
 
 class Barrier:
-    def __init__(self, size):
+    def __init__(self, size, action=None):
         self.size = size
-        self.occupancy = 0
-        self.releasing_count = 0
-        self.cv = Condition()
+        # Run by the last thread to arrive, before the rest are released
+        self.action = action
+        self.lock = Lock()
+        self.generation = Generation(self.lock)
+        self.arrivals = 0
+        self.generations = 0
 
     def arrived(self):
+        return self.wait()
+
+    def wait(self, timeout=None):
+        with self.lock:
+            gen = self.generation
+            if gen.broken:
+                raise BrokenBarrierError
+            index = self.arrivals
+            self.arrivals += 1
+
+            if self.arrivals == self.size:
+                if self.action is not None:
+                    try:
+                        self.action()
+                    except BaseException:
+                        self.break_generation()
+                        raise
+                self.next_generation()
+                return index
+
+            # Late arrivals never wait for a drain: once this generation trips,
+            # they land straight in the next one.
+            if not gen.cv.wait_for(lambda: gen.tripped or gen.broken, timeout):
+                self.break_generation()
+            if gen.broken:
+                raise BrokenBarrierError
+            return index
+
+    def next_generation(self):
+        self.generation.tripped = True
+        self.generation.cv.notify_all()
+        self.generation = Generation(self.lock)
+        self.arrivals = 0
+        self.generations += 1
+
+    def break_generation(self):
+        self.generation.broken = True
+        self.generation.cv.notify_all()
+
+    def abort(self):
+        with self.lock:
+            self.break_generation()
+
+    def reset(self):
+        with self.lock:
+            # Anyone still waiting gets BrokenBarrierError; new arrivals start clean
+            if self.arrivals:
+                self.break_generation()
+            self.generation = Generation(self.lock)
+            self.arrivals = 0
+
+    @property
+    def broken(self):
+        return self.generation.broken
+
+    @property
+    def n_waiting(self):
+        return self.arrivals
+
+
+class TreeNode:
+    def __init__(self, expected, parent=None):
+        self.expected = expected
+        self.parent = parent
+        self.arrivals = 0
+        self.generation = 0
+        self.cv = Condition()
+
+    def arrive(self):
         with self.cv:
-            # No new threads can enter if we're at capacity; this
-            # is required to prevent race conditions when releasing
-            while self.occupancy == self.size:
-                print(f"{current_thread().getName()} at capacity (flushing). No entry allowed.")
-                self.cv.wait()
-
-            # Bump occupancy and wait if necessary until full
-            self.occupancy += 1
-            if self.occupancy == self.size:
-                print(f"{current_thread().getName()} occupancy {self.occupancy}/{self.size}. Releasing.")
-                self.releasing_count = self.size
-            else:
-                print(f"{current_thread().getName()} occupancy {self.occupancy}/{self.size}. Waiting.")
-                while self.occupancy < self.size:
+            gen = self.generation
+            self.arrivals += 1
+            if self.arrivals < self.expected:
+                while self.generation == gen:
                     self.cv.wait()
+                return
+            self.arrivals = 0
 
-            # Gates have been opened, this thread is leaving.
-            self.releasing_count -= 1
-            if self.releasing_count == 0:
-                self.occupancy = 0
-
-            print(f"{current_thread().getName()} released")
+        # Last one in carries the whole group up a level, outside this node's lock.
+        # Nobody else can arrive here until we release them below.
+        if self.parent is not None:
+            self.parent.arrive()
+        with self.cv:
+            self.generation += 1
             self.cv.notify_all()
 
+
+class TreeBarrier:
+    """Combining-tree barrier: threads only contend with the fan_in - 1 others in their node."""
+
+    def __init__(self, size, fan_in=4):
+        self.size = size
+        self.fan_in = fan_in
+        self.leaves = self.build_tree(size, fan_in)
+        self.local = threading.local()
+        self.assign_lock = Lock()
+        self.assigned = 0
+
+    @staticmethod
+    def build_tree(size, fan_in):
+        leaves = level = [
+            TreeNode(min(fan_in, size - i)) for i in range(0, size, fan_in)
+        ]
+        while len(level) > 1:
+            parents = [
+                TreeNode(min(fan_in, len(level) - i)) for i in range(0, len(level), fan_in)
+            ]
+            for i, node in enumerate(level):
+                node.parent = parents[i // fan_in]
+            level = parents
+        return leaves
+
+    def leaf(self):
+        # Threads are pinned to a leaf the first time they arrive
+        if (leaf := getattr(self.local, "leaf", None)) is None:
+            with self.assign_lock:
+                if self.assigned == self.size:
+                    raise RuntimeError(f"more than {self.size} threads using barrier")
+                leaf = self.local.leaf = self.leaves[self.assigned // self.fan_in]
+                self.assigned += 1
+        return leaf
+
+    def arrived(self):
+        self.leaf().arrive()
+
+    wait = arrived
+
+
+ARRIVALS, GENERATION = range(2)
+
+
+class SharedMemoryBarrier:
+    """Barrier whose counters live in shared memory, for use across processes.
+
+    Hand it to workers when they are created (Process args or a Pool
+    initializer), since the lock can only be shared by inheritance.
+    """
+
+    SPINS_BEFORE_SLEEP = 100
+    SLEEP_S = 0.0001
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = multiprocessing.Lock()
+        self.shm = SharedMemory(create=True, size=2 * 8)
+        self.attach()
+        self.counters[ARRIVALS] = self.counters[GENERATION] = 0
+
+    def attach(self):
+        self.counters = self.shm.buf.cast("q")
+
+    def __getstate__(self):
+        return {"size": self.size, "lock": self.lock, "shm": self.shm}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    def arrived(self):
+        with self.lock:
+            gen = self.counters[GENERATION]
+            self.counters[ARRIVALS] += 1
+            if self.counters[ARRIVALS] == self.size:
+                self.counters[ARRIVALS] = 0
+                self.counters[GENERATION] = gen + 1
+                return
+
+        # No cross-process Condition to park on, so spin briefly then back off
+        spins = 0
+        while self.counters[GENERATION] == gen:
+            spins += 1
+            time.sleep(0 if spins < self.SPINS_BEFORE_SLEEP else self.SLEEP_S)
+
+    wait = arrived
+
+    def close(self):
+        self.counters.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
 def arrive(barrier, times, cadence_s):
     for _ in range(times):
         time.sleep(cadence_s)
         print(f"{current_thread().getName()} reached the barrier.")
-        barrier.arrived()
+        index = barrier.arrived()
+        print(f"{current_thread().getName()} released (arrival {index + 1}/{barrier.size})")
+
+
+def phases_per_second(barrier, parties, phases):
+    def run():
+        for _ in range(phases):
+            barrier.wait()
+
+    threads = [Thread(target=run) for _ in range(parties)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return phases / (time.perf_counter() - start)
+
+
+def run_phases(barrier, phases, results):
+    # Line everyone up first so process start-up isn't counted
+    barrier.wait()
+    start = time.perf_counter()
+    for _ in range(phases):
+        barrier.wait()
+    results.put(phases / (time.perf_counter() - start))
+
+
+def process_phases_per_second(barrier, parties, phases):
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=run_phases, args=(barrier, phases, results))
+        for _ in range(parties)
+    ]
+    for proc in procs:
+        proc.start()
+    rates = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    return min(rates)
+
+
+def bench(phases=200):
+    for parties in (4, 16, 64, 256):
+        ours = phases_per_second(Barrier(parties), parties, phases)
+        stdlib = phases_per_second(threading.Barrier(parties), parties, phases)
+        tree = phases_per_second(TreeBarrier(parties, fan_in=4), parties, phases)
+        print(
+            f"threads={parties:<4} Barrier={ours:>9,.0f} TreeBarrier(4)={tree:>9,.0f} threading.Barrier={stdlib:>9,.0f} phases/s"
+        )
+    for parties in (2, 4, 8):
+        shm_barrier = SharedMemoryBarrier(parties)
+        shm = process_phases_per_second(shm_barrier, parties, phases * 5)
+        shm_barrier.close()
+        shm_barrier.unlink()
+        mp = process_phases_per_second(multiprocessing.Barrier(parties), parties, phases * 5)
+        print(
+            f"procs={parties:<6} SharedMemoryBarrier={shm:>9,.0f} multiprocessing.Barrier={mp:>9,.0f} phases/s"
+        )
+
 
 def main():
-    barrier = Barrier(3)
+    barrier = Barrier(
+        3, action=lambda: print(f"{current_thread().getName()} tripped the barrier.")
+    )
 
     threads = [Thread(name=f"Thread-{i}", target=arrive, args=(barrier, 5, 0.5 * i ** 2)) for i in range(5)]
     for thread in threads:
@@ -51,4 +286,7 @@ def main():
         thread.join()
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["bench"]:
+        bench()
+    else:
+        main()
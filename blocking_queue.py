@@ -1,41 +1,478 @@
-from threading import Condition, Thread, current_thread
+from collections import deque
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty, Full, Queue
+from threading import Condition, Event, Lock, Thread, current_thread, local
+import asyncio
+import itertools
+import multiprocessing
 import random
+import struct
+import sys
 import time
 
 
 class BlockingQueue:
+    """Fixed-capacity ring buffer with separate not-full and not-empty conditions."""
+
     def __init__(self, max_size):
         self.max_size = int(max_size)
         self.curr_size = 0
-        self.queue = []
-        self.cond = Condition()
+        self.head = 0
+        self.buffer = [None] * self.max_size
+        self.lock = Lock()
+        # Producers only ever wait on not_full and consumers on not_empty, so a
+        # notify never wakes a thread of the wrong kind.
+        self.not_full = Condition(self.lock)
+        self.not_empty = Condition(self.lock)
 
-    def enqueue(self, item):
-        self.cond.acquire()
-        while self.curr_size >= self.max_size:
-            self.cond.wait()
+    def enqueue(self, item, timeout=None):
+        with self.not_full:
+            # Check before wait_for so the uncontended path skips building a predicate
+            if self.curr_size >= self.max_size and not self.not_full.wait_for(
+                lambda: self.curr_size < self.max_size, timeout
+            ):
+                raise Full
+            self.put(item)
+            self.not_empty.notify()
 
-        self.queue.append(item)
-        self.curr_size += 1
-        self.cond.notify_all()
-        self.cond.release()
+    def dequeue(self, timeout=None):
+        with self.not_empty:
+            if self.curr_size == 0 and not self.not_empty.wait_for(
+                lambda: self.curr_size > 0, timeout
+            ):
+                raise Empty
+            item = self.take()
+            self.not_full.notify()
+        return item
+
+    def enqueue_many(self, items, timeout=None):
+        """Enqueue items in as few lock holds as space allows. Returns how many made it in."""
+        items = list(items)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        added = 0
+        with self.not_full:
+            while added < len(items):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not self.not_full.wait_for(
+                    lambda: self.curr_size < self.max_size, remaining
+                ):
+                    break
+                batch = min(len(items) - added, self.max_size - self.curr_size)
+                for item in items[added : added + batch]:
+                    self.put(item)
+                added += batch
+                self.not_empty.notify(batch)
+        return added
 
-    def dequeue(self):
-        self.cond.acquire()
-        while self.curr_size == 0:
-            self.cond.wait()
+    def dequeue_many(self, max_items, timeout=None):
+        """Block until at least one item is available, then drain up to max_items."""
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.curr_size > 0, timeout):
+                return []
+            items = [self.take() for _ in range(min(max_items, self.curr_size))]
+            self.not_full.notify(len(items))
+        return items
 
-        item = self.queue.pop(0)
+    # put/take assume the lock is held and the buffer has room/an item
+    def put(self, item):
+        self.buffer[(self.head + self.curr_size) % self.max_size] = item
+        self.curr_size += 1
+
+    def take(self):
+        item = self.buffer[self.head]
+        self.buffer[self.head] = None
+        self.head = (self.head + 1) % self.max_size
         self.curr_size -= 1
-        self.cond.notify_all()
-        self.cond.release()
         return item
 
+    def __len__(self):
+        return self.curr_size
+
     @property
     def is_full(self):
         return self.curr_size >= self.max_size
 
 
+# Returned by the sharded queue's lane probes when they come up empty-handed
+NOTHING = object()
+
+
+class ShardedBlockingQueue:
+    """BlockingQueue spread over independent lanes, each with its own lock.
+
+    Producers pick a lane by key hash or round-robin, consumers start at their
+    home lane and steal from the rest before parking. FIFO order only holds
+    within a lane.
+    """
+
+    def __init__(self, max_size, n_lanes=8):
+        self.max_size = int(max_size)
+        # Lanes split max_size exactly, so every lane is full just when the
+        # whole queue is, and the parking check below agrees with the lanes
+        n_lanes = max(1, min(n_lanes, self.max_size))
+        per_lane, extra = divmod(self.max_size, n_lanes)
+        self.lanes = [BlockingQueue(per_lane + (i < extra)) for i in range(n_lanes)]
+        self.next_lane = itertools.count()
+        self.local = local()
+        # Only threads that found every lane full/empty park here, so the
+        # fast path never touches this lock.
+        self.parked = Lock()
+        self.space_available = Condition(self.parked)
+        self.items_available = Condition(self.parked)
+        self.waiting_producers = 0
+        self.waiting_consumers = 0
+
+    def enqueue(self, item, key=None, timeout=None):
+        start = (hash(key) if key is not None else next(self.next_lane)) % len(self.lanes)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.try_enqueue(item, start):
+            with self.parked:
+                self.waiting_producers += 1
+                try:
+                    # Re-scan after announcing ourselves: a consumer that freed a slot
+                    # in between either shows up here or sees us waiting and notifies.
+                    while self.approx_size() >= self.max_size:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if not self.space_available.wait(remaining) and remaining is not None:
+                            raise Full
+                finally:
+                    self.waiting_producers -= 1
+        if self.waiting_consumers:
+            with self.parked:
+                self.items_available.notify()
+
+    def dequeue(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while (item := self.try_dequeue(self.home_lane())) is NOTHING:
+            with self.parked:
+                self.waiting_consumers += 1
+                try:
+                    while self.approx_size() == 0:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if not self.items_available.wait(remaining) and remaining is not None:
+                            raise Empty
+                finally:
+                    self.waiting_consumers -= 1
+        if self.waiting_producers:
+            with self.parked:
+                self.space_available.notify()
+        return item
+
+    # Nobody ever blocks on a lane's own conditions, so these go straight to the
+    # ring under the lane lock instead of through enqueue/dequeue.
+    def try_enqueue(self, item, start):
+        for i in range(len(self.lanes)):
+            lane = self.lanes[(start + i) % len(self.lanes)]
+            # Unlocked size check is only a hint; the lane's own lock decides
+            if lane.curr_size < lane.max_size:
+                with lane.lock:
+                    if lane.curr_size < lane.max_size:
+                        lane.put(item)
+                        return True
+        return False
+
+    def try_dequeue(self, start):
+        for i in range(len(self.lanes)):
+            lane = self.lanes[(start + i) % len(self.lanes)]
+            if lane.curr_size:
+                with lane.lock:
+                    if lane.curr_size:
+                        return lane.take()
+        return NOTHING
+
+    def home_lane(self):
+        if (home := getattr(self.local, "home", None)) is None:
+            home = self.local.home = next(self.next_lane) % len(self.lanes)
+        return home
+
+    def approx_size(self):
+        # Sums each lane's counter without taking any lane locks
+        return sum(lane.curr_size for lane in self.lanes)
+
+    def __len__(self):
+        return self.approx_size()
+
+    @property
+    def is_full(self):
+        return self.approx_size() >= self.max_size
+
+
+# Shared header: byte positions only ever grow; offsets into the ring are taken mod capacity
+HEAD, RESERVED, TAIL, READY = range(4)
+HEADER_SIZE = 4 * 8
+# Every record starts with (payload length, state) and is padded to 8 bytes
+RECORD_HEADER = struct.Struct("II")
+RECORD_STATE = struct.Struct("I")
+WRITTEN, CONSUMED, PADDING = range(3)
+
+
+def record_size(length):
+    return (RECORD_HEADER.size + length + 7) & ~7
+
+
+class SharedMemoryBlockingQueue:
+    """BlockingQueue of bytes stored as length-prefixed records in shared memory.
+
+    dequeue() hands back a Record whose view points straight into the ring;
+    its space is only reclaimed once the Record is released. Like
+    SharedMemoryBarrier it must reach workers at creation time.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = record_size(capacity - RECORD_HEADER.size)
+        self.lock = multiprocessing.Lock()
+        self.not_full = multiprocessing.Condition(self.lock)
+        self.not_empty = multiprocessing.Condition(self.lock)
+        self.shm = SharedMemory(create=True, size=HEADER_SIZE + self.capacity)
+        self.attach()
+        for field in (HEAD, RESERVED, TAIL, READY):
+            self.header[field] = 0
+
+    def attach(self):
+        self.header = self.shm.buf[:HEADER_SIZE].cast("Q")
+        self.ring = self.shm.buf[HEADER_SIZE:]
+
+    def __getstate__(self):
+        return {
+            "capacity": self.capacity,
+            "lock": self.lock,
+            "not_full": self.not_full,
+            "not_empty": self.not_empty,
+            "shm": self.shm,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    def enqueue(self, data, timeout=None):
+        size = record_size(len(data))
+        if size > self.capacity:
+            raise ValueError(f"{len(data)} byte record can't fit in {self.capacity} byte queue")
+
+        with self.not_full:
+            if not self.not_full.wait_for(lambda: self.make_room(size), timeout):
+                raise Full
+            offset = self.header[TAIL] % self.capacity
+            # Records never wrap, so consumers always get one contiguous view
+            if self.capacity - offset < size:
+                RECORD_HEADER.pack_into(self.ring, offset, 0, PADDING)
+                self.header[TAIL] += self.capacity - offset
+                offset = 0
+            RECORD_HEADER.pack_into(self.ring, offset, len(data), WRITTEN)
+            start = offset + RECORD_HEADER.size
+            self.ring[start : start + len(data)] = data
+            self.header[TAIL] += size
+            self.header[READY] += 1
+            self.not_empty.notify()
+
+    def make_room(self, size):
+        # Assumes the lock is held. An empty ring starts over at offset 0, so a
+        # record bigger than what's left past the tail still fits
+        tail = self.header[TAIL]
+        if self.header[HEAD] == tail and tail % self.capacity:
+            tail += self.capacity - tail % self.capacity
+            for field in (HEAD, RESERVED, TAIL):
+                self.header[field] = tail
+        return self.room_for(size)
+
+    def room_for(self, size):
+        tail = self.header[TAIL]
+        free = self.capacity - (tail - self.header[HEAD])
+        to_end = self.capacity - tail % self.capacity
+        return free >= (size if size <= to_end else to_end + size)
+
+    def dequeue(self, timeout=None):
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.header[READY] > 0, timeout):
+                raise Empty
+            offset = self.skip_padding(RESERVED)
+            length, _ = RECORD_HEADER.unpack_from(self.ring, offset)
+            self.header[RESERVED] += record_size(length)
+            self.header[READY] -= 1
+        start = offset + RECORD_HEADER.size
+        return Record(self, offset, self.ring[start : start + length])
+
+    def dequeue_bytes(self, timeout=None):
+        with self.dequeue(timeout) as view:
+            return bytes(view)
+
+    def release(self, offset):
+        with self.lock:
+            RECORD_STATE.pack_into(self.ring, offset + 4, CONSUMED)
+            # Records can be released out of order; only reclaim the consumed prefix
+            freed = False
+            while self.header[HEAD] < self.header[RESERVED]:
+                head = self.skip_padding(HEAD)
+                length, state = RECORD_HEADER.unpack_from(self.ring, head)
+                if state != CONSUMED:
+                    break
+                self.header[HEAD] += record_size(length)
+                freed = True
+            if freed:
+                # Waiting producers may need different amounts of space, so let them all re-check
+                self.not_full.notify_all()
+
+    def skip_padding(self, field):
+        offset = self.header[field] % self.capacity
+        _, state = RECORD_HEADER.unpack_from(self.ring, offset)
+        if state == PADDING:
+            self.header[field] += self.capacity - offset
+            offset = 0
+        return offset
+
+    def __len__(self):
+        return self.header[READY]
+
+    @property
+    def used_bytes(self):
+        return self.header[TAIL] - self.header[HEAD]
+
+    @property
+    def occupancy(self):
+        return self.used_bytes / self.capacity
+
+    @property
+    def is_full(self):
+        return not self.room_for(record_size(1))
+
+    def close(self):
+        self.header.release()
+        self.ring.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class Record:
+    def __init__(self, queue, offset, view):
+        self.queue = queue
+        self.offset = offset
+        self.view = view
+
+    def release(self):
+        self.view.release()
+        self.queue.release(self.offset)
+
+    def __enter__(self):
+        return self.view
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def wake_future(loop, future):
+    loop.call_soon_threadsafe(set_pending, future)
+
+
+def set_pending(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AsyncBlockingQueue:
+    """BlockingQueue shared between threads and coroutines, in either direction.
+
+    Threads use enqueue/dequeue and block; coroutines await enqueue_async/
+    dequeue_async and are woken through their loop's call_soon_threadsafe, so
+    no thread is parked on their behalf.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = int(max_size)
+        self.items = deque()
+        self.lock = Lock()
+        # FIFO of wake callbacks for parked putters/getters of either kind. A
+        # woken waiter re-checks under the lock, so a wakeup is only a hint.
+        self.putters = deque()
+        self.getters = deque()
+
+    def enqueue(self, item, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if len(self.items) < self.max_size:
+                    self.items.append(item)
+                    self.wake_next(self.getters)
+                    return
+                event = Event()
+                self.putters.append(event.set)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not event.wait(remaining):
+                self.abandon(self.putters, event.set)
+                raise Full
+
+    def dequeue(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if self.items:
+                    item = self.items.popleft()
+                    self.wake_next(self.putters)
+                    return item
+                event = Event()
+                self.getters.append(event.set)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not event.wait(remaining):
+                self.abandon(self.getters, event.set)
+                raise Empty
+
+    async def enqueue_async(self, item):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if len(self.items) < self.max_size:
+                    self.items.append(item)
+                    self.wake_next(self.getters)
+                    return
+                future = loop.create_future()
+                wake = partial(wake_future, loop, future)
+                self.putters.append(wake)
+            try:
+                await future
+            except asyncio.CancelledError:
+                self.abandon(self.putters, wake)
+                raise
+
+    async def dequeue_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.items:
+                    item = self.items.popleft()
+                    self.wake_next(self.putters)
+                    return item
+                future = loop.create_future()
+                wake = partial(wake_future, loop, future)
+                self.getters.append(wake)
+            try:
+                await future
+            except asyncio.CancelledError:
+                self.abandon(self.getters, wake)
+                raise
+
+    def wake_next(self, waiters):
+        if waiters:
+            waiters.popleft()()
+
+    def abandon(self, waiters, wake):
+        with self.lock:
+            try:
+                waiters.remove(wake)
+            except ValueError:
+                # Already woken as we gave up; hand the wakeup to the next in line
+                self.wake_next(waiters)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def is_full(self):
+        return len(self.items) >= self.max_size
+
+
 def consumer_thread(queue):
     while True:
         item = queue.dequeue()
@@ -78,5 +515,214 @@ def main():
     time.sleep(30)
 
 
+def drain(queue, batch_size):
+    # None is the shutdown sentinel; one is sent per consumer
+    if batch_size == 1:
+        while queue.dequeue() is not None:
+            pass
+    else:
+        while (stops := queue.dequeue_many(batch_size).count(None)) == 0:
+            pass
+        # A batch can swallow other consumers' sentinels; hand them back
+        queue.enqueue_many([None] * (stops - 1))
+
+
+def throughput(queue, producers, consumers, n_items, batch_size=1):
+    per_producer = n_items // producers
+
+    def produce():
+        for i in range(per_producer):
+            queue.enqueue(i)
+
+    producer_threads = [Thread(target=produce) for _ in range(producers)]
+    consumer_threads = [
+        Thread(target=drain, args=(queue, batch_size)) for _ in range(consumers)
+    ]
+    start = time.perf_counter()
+    for thread in producer_threads + consumer_threads:
+        thread.start()
+    for thread in producer_threads:
+        thread.join()
+    # Sentinels only go in once the queue has drained, since a sharded queue
+    # could hand one out ahead of items still sitting in other lanes
+    while len(queue):
+        time.sleep(0.001)
+    for _ in consumer_threads:
+        queue.enqueue(None)
+    for thread in consumer_threads:
+        thread.join()
+    return per_producer * producers / (time.perf_counter() - start)
+
+
+class StdlibQueue(Queue):
+    # queue.Queue under BlockingQueue's method names, as a baseline
+    enqueue = Queue.put
+    dequeue = Queue.get
+    __len__ = Queue.qsize
+
+
+def bench(n_items=100_000, max_size=1024):
+    for producers in (1, 4, 16):
+        for consumers in (1, 4, 16):
+            ring = throughput(BlockingQueue(max_size), producers, consumers, n_items)
+            batched = throughput(
+                BlockingQueue(max_size), producers, consumers, n_items, batch_size=64
+            )
+            stdlib = throughput(StdlibQueue(max_size), producers, consumers, n_items)
+            print(
+                f"{producers:>2}P/{consumers:<2}C BlockingQueue={ring:>9,.0f} dequeue_many(64)={batched:>9,.0f} queue.Queue={stdlib:>9,.0f} items/s"
+            )
+
+
+def bench_sharded(n_items=200_000, max_size=1024):
+    for threads in (2, 4, 8, 16, 32, 64):
+        half = threads // 2
+        single = throughput(BlockingQueue(max_size), half, half, n_items)
+        sharded = throughput(ShardedBlockingQueue(max_size, n_lanes=8), half, half, n_items)
+        print(
+            f"threads={threads:<3} BlockingQueue={single:>9,.0f} ShardedBlockingQueue(8)={sharded:>9,.0f} ops/s"
+        )
+
+
+def produce_records(put, record, count):
+    for _ in range(count):
+        put(record)
+    put(b"")
+
+
+def consume_shm_records(queue):
+    while True:
+        with queue.dequeue() as view:
+            if not len(view):
+                return
+
+
+def consume_mp_records(queue):
+    while queue.get():
+        pass
+
+
+def bench_processes(capacity=16 * 1024 * 1024, total_bytes=64 * 1024 * 1024):
+    for record_bytes in (64, 1024, 64 * 1024, 1024 * 1024):
+        record = b"x" * record_bytes
+        count = min(max(total_bytes // record_bytes, 200), 200_000)
+        shm_queue = SharedMemoryBlockingQueue(capacity)
+        results = []
+        mp_queue = multiprocessing.Queue()
+        for queue, put, consume in (
+            (shm_queue, shm_queue.enqueue, consume_shm_records),
+            (mp_queue, mp_queue.put, consume_mp_records),
+        ):
+            procs = [
+                multiprocessing.Process(target=produce_records, args=(put, record, count)),
+                multiprocessing.Process(target=consume, args=(queue,)),
+            ]
+            start = time.perf_counter()
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+            results.append(time.perf_counter() - start)
+        shm_queue.close()
+        shm_queue.unlink()
+        print(
+            f"{record_bytes:>8} B "
+            + " ".join(
+                f"{name}={count * record_bytes / elapsed / 1e6:>8,.1f} MB/s {count / elapsed:>9,.0f} rec/s"
+                for name, elapsed in zip(("SharedMemoryBlockingQueue", "multiprocessing.Queue"), results)
+            )
+        )
+
+
+def percentiles(samples, *pcts):
+    samples = sorted(samples)
+    return [samples[min(len(samples) - 1, int(len(samples) * pct / 100))] for pct in pcts]
+
+
+def timestamp_producer(put, n_samples, interval_s):
+    for _ in range(n_samples):
+        put(time.perf_counter())
+        time.sleep(interval_s)
+
+
+async def wakeup_latencies(get, n_samples):
+    latencies = []
+    for _ in range(n_samples):
+        sent_at = await get()
+        latencies.append(time.perf_counter() - sent_at)
+    return latencies
+
+
+def bench_async(n_samples=2000, n_consumers=10_000, n_items=200_000):
+    async def measure_latency(queue, get):
+        producer = Thread(
+            target=timestamp_producer, args=(queue.enqueue, n_samples, 0.0005)
+        )
+        producer.start()
+        latencies = await wakeup_latencies(get, n_samples)
+        producer.join()
+        return latencies
+
+    async def via_executor():
+        # Today's option: park a thread from the default executor on dequeue()
+        queue = BlockingQueue(1024)
+        loop = asyncio.get_running_loop()
+        return await measure_latency(
+            queue, lambda: loop.run_in_executor(None, queue.dequeue)
+        )
+
+    async def via_bridge():
+        queue = AsyncBlockingQueue(1024)
+        return await measure_latency(queue, queue.dequeue_async)
+
+    for name, run in (("run_in_executor", via_executor), ("AsyncBlockingQueue", via_bridge)):
+        p50, p99, worst = percentiles(asyncio.run(run()), 50, 99, 100)
+        print(
+            f"thread->coroutine wakeup {name:<19} p50={p50 * 1e6:7.1f}us p99={p99 * 1e6:7.1f}us max={worst * 1e6:7.1f}us"
+        )
+
+    async def fan_out(producers=4):
+        queue = AsyncBlockingQueue(1024)
+        consumed = 0
+        all_consumed = asyncio.Event()
+
+        async def consume():
+            nonlocal consumed
+            while True:
+                await queue.dequeue_async()
+                consumed += 1
+                if consumed == n_items:
+                    all_consumed.set()
+
+        consumers = [asyncio.create_task(consume()) for _ in range(n_consumers)]
+        # Let every consumer park before any items show up
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        threads = [
+            Thread(target=lambda: [queue.enqueue(i) for i in range(n_items // producers)])
+            for _ in range(producers)
+        ]
+        for thread in threads:
+            thread.start()
+        await all_consumed.wait()
+        elapsed = time.perf_counter() - start
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+        for thread in threads:
+            thread.join()
+        return n_items / elapsed
+
+    print(
+        f"{n_consumers} pending coroutine consumers, 4 producer threads: {asyncio.run(fan_out()):,.0f} items/s"
+    )
+
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["bench"]:
+        bench()
+        bench_sharded()
+        bench_processes()
+        bench_async()
+    else:
+        main()
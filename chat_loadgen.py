@@ -0,0 +1,485 @@
+"""Load generator and latency benchmark for the chat servers.
+
+Runs the chosen server in its own process, connects thousands of simulated
+clients that tell each other timestamped messages at a target aggregate rate,
+and prints a JSON report so runs can be compared across commits:
+
+    python chat_loadgen.py async --clients 2000 --rate 5000 --duration 10
+    python chat_loadgen.py async --clients 2000 --rate 5000 --protocol binary
+
+With --churn N it instead opens, registers and drops N connections, sampling
+the server's CPU time and RSS along the way; both should grow linearly with the
+work done and no further, and the server should sit idle once the churn stops:
+
+    python chat_loadgen.py threaded --churn 100000
+
+With --offline N it tells N messages to a user who isn't connected, so the
+server logs them, then registers that user and times the replay:
+
+    python chat_loadgen.py selectors --offline 1000000
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from chat_protocol import (
+    BINARY_MAGIC,
+    BINARY_PONG,
+    DELIMITER,
+    OP_PING,
+    OP_REGISTER,
+    OP_TELL,
+    PONG,
+    BinaryParser,
+    FrameParser,
+    frame,
+    pack,
+    parse_stats,
+)
+from chat_server_asnc import ChatServerAsync
+from chat_server_threaded import ChatServerThreaded, Engine
+from message_log import MessageLog
+
+
+def open_log(log_dir):
+    return None if log_dir is None else MessageLog(log_dir)
+
+
+def run_threaded_server(port, log_dir=None):
+    ChatServerThreaded(port, verbose=False, message_log=open_log(log_dir)).run_server()
+
+
+def run_selectors_server(port, log_dir=None):
+    ChatServerThreaded(
+        port, verbose=False, engine=Engine.SELECTORS, message_log=open_log(log_dir)
+    ).run_server()
+
+
+def run_async_server(port, log_dir=None):
+    srv = ChatServerAsync(port, verbose=False, message_log=open_log(log_dir))
+
+    async def serve():
+        server = await asyncio.start_server(srv.run_server, "127.0.0.1", port)
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+SERVERS = {
+    "threaded": run_threaded_server,
+    "selectors": run_selectors_server,
+    "async": run_async_server,
+}
+
+
+def free_port():
+    # Random picks can land on an ephemeral port still held by an earlier run's clients
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, port, log_dir=None):
+    proc = multiprocessing.Process(target=SERVERS[kind], args=(port, log_dir), daemon=True)
+    proc.start()
+    # Wait until it's accepting before the clock starts on anything. The probe
+    # stays open until shutdown: a dropped connection is a dead peer to the server.
+    while True:
+        try:
+            return proc, socket.create_connection(("127.0.0.1", port), timeout=1)
+        except OSError:
+            if not proc.is_alive():
+                raise RuntimeError(f"{kind} server exited with {proc.exitcode}")
+            time.sleep(0.05)
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return None
+
+
+def cpu_s(pid):
+    with open(f"/proc/{pid}/stat") as stat:
+        # utime and stime, fields 14 and 15; the command name before ")" may contain spaces
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else None
+
+
+class SimulatedClient:
+    def __init__(self, name):
+        self.name = name
+        # What peers put in a tell to reach this client
+        self.address = name
+        self.parser = FrameParser()
+        self.reader = None
+        self.writer = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def write(self, data):
+        self.bytes_sent += len(data)
+        self.writer.write(data)
+
+    async def read(self, n):
+        data = await self.reader.read(n)
+        self.bytes_received += len(data)
+        return data
+
+    async def connect(self, srv_host, srv_port):
+        self.reader, self.writer = await asyncio.open_connection(srv_host, srv_port)
+        self.write(frame(f"register,{self.name}"))
+        await self.writer.drain()
+        while not self.parser.feed(data := await self.read(4096)):
+            if not data:
+                raise ConnectionError(f"server closed {self.name}'s connection")
+
+    def timestamps(self, frames):
+        for msg in frames:
+            if msg == "ping":
+                self.write(PONG)
+                continue
+            # "<sender>: <perf_counter at send> <padding>"; anything else is a server notice
+            sender, _, body = msg.partition(": ")
+            if sender.startswith("load-"):
+                yield float(body.split(" ", 1)[0])
+
+    def tell(self, recipient, body):
+        return frame(f"tell,{recipient},{body}")
+
+    async def receive(self, latencies):
+        while data := await self.read(65536):
+            now = time.perf_counter()
+            for sent_at in self.timestamps(self.parser.feed(data)):
+                latencies.append(now - sent_at)
+
+    async def send(self, peers, rate_per_s, deadline, padding):
+        sent = 0
+        while (send_at := time.perf_counter() + random.expovariate(rate_per_s)) < deadline:
+            await asyncio.sleep(send_at - time.perf_counter())
+            self.write(self.tell(random.choice(peers), f"{time.perf_counter():.6f} {padding}"))
+            await self.writer.drain()
+            sent += 1
+        return sent
+
+
+class BinarySimulatedClient(SimulatedClient):
+    def __init__(self, name):
+        super().__init__(name)
+        self.parser = BinaryParser()
+
+    async def connect(self, srv_host, srv_port):
+        self.reader, self.writer = await asyncio.open_connection(srv_host, srv_port)
+        self.write(BINARY_MAGIC + pack(OP_REGISTER, 0, self.name.encode()))
+        await self.writer.drain()
+        while not (frames := self.parser.feed(data := await self.read(4096))):
+            if not data:
+                raise ConnectionError(f"server closed {self.name}'s connection")
+        [(_, self.address, _)] = frames
+
+    def timestamps(self, frames):
+        for op, sender_id, payload in frames:
+            if op == OP_PING:
+                self.write(BINARY_PONG)
+            elif op == OP_TELL:
+                yield float(payload.split(b" ", 1)[0])
+
+    def tell(self, recipient, body):
+        return pack(OP_TELL, recipient, body.encode())
+
+
+CLIENTS = {"text": SimulatedClient, "binary": BinarySimulatedClient}
+
+
+async def connect_all(clients, srv_host, srv_port, concurrency):
+    # Bounded so a server with a tiny accept backlog sees retries rather than a SYN flood
+    limit = asyncio.Semaphore(concurrency)
+
+    async def connect(client):
+        async with limit:
+            await client.connect(srv_host, srv_port)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    return time.perf_counter() - start
+
+
+async def run_load(
+    srv_host, srv_port, server_pid, protocol, n_clients, rate, duration_s, msg_size, concurrency
+):
+    clients = [CLIENTS[protocol](f"load-{i}") for i in range(n_clients)]
+    connect_s = await connect_all(clients, srv_host, srv_port, concurrency)
+    peers = [client.address for client in clients]
+    # Only the message phase counts towards bytes and CPU per message
+    bytes_before = sum(client.bytes_sent + client.bytes_received for client in clients)
+    cpu_before = cpu_s(server_pid)
+
+    latencies = []
+    receivers = [asyncio.create_task(client.receive(latencies)) for client in clients]
+    padding = "x" * msg_size
+    deadline = time.perf_counter() + duration_s
+    start = time.perf_counter()
+    sent = sum(
+        await asyncio.gather(
+            *(client.send(peers, rate / n_clients, deadline, padding) for client in clients)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    # Let in-flight messages land before counting
+    await asyncio.sleep(1)
+    server_cpu = cpu_s(server_pid) - cpu_before
+    wire_bytes = sum(client.bytes_sent + client.bytes_received for client in clients) - bytes_before
+
+    for receiver in receivers:
+        receiver.cancel()
+    for client in clients:
+        client.writer.close()
+    return connect_s, sent, elapsed, latencies, server_cpu, wire_bytes
+
+
+def run(
+    kind, n_clients, rate, duration_s, msg_size=0, concurrency=100, port=None, protocol="text"
+):
+    port = port or free_port()
+    server, probe = start_server(kind, port)
+    try:
+        connect_s, sent, elapsed, latencies, server_cpu, wire_bytes = asyncio.run(
+            run_load(
+                "127.0.0.1",
+                port,
+                server.pid,
+                protocol,
+                n_clients,
+                rate,
+                duration_s,
+                msg_size,
+                concurrency,
+            )
+        )
+        server_rss_kb = rss_kb(server.pid)
+    finally:
+        server.terminate()
+        server.join()
+        probe.close()
+
+    latencies.sort()
+    return {
+        "server": kind,
+        "protocol": protocol,
+        "commit": current_commit(),
+        "clients": n_clients,
+        "target_rate": rate,
+        "duration_s": duration_s,
+        "msg_size": msg_size,
+        "sent": sent,
+        "delivered": len(latencies),
+        "msgs_per_s": len(latencies) / elapsed,
+        "latency_ms": {
+            name: None if value is None else value * 1000
+            for name, value in (
+                ("p50", percentile(latencies, 50)),
+                ("p95", percentile(latencies, 95)),
+                ("p99", percentile(latencies, 99)),
+                ("max", latencies[-1] if latencies else None),
+            )
+        },
+        "connects_per_s": n_clients / connect_s,
+        "server_rss_kb": server_rss_kb,
+        # Both directions, as seen by the clients: the tell in and its delivery out
+        "wire_bytes_per_msg": wire_bytes / len(latencies) if latencies else None,
+        "server_cpu_us_per_msg": server_cpu * 1e6 / len(latencies) if latencies else None,
+    }
+
+
+async def query_stats(srv_host, srv_port):
+    reader, writer = await asyncio.open_connection(srv_host, srv_port)
+    writer.write(frame("stats"))
+    stats = parse_stats((await reader.readuntil(DELIMITER)).decode())
+    writer.close()
+    return stats
+
+
+async def churn_once(srv_host, srv_port, name):
+    reader, writer = await asyncio.open_connection(srv_host, srv_port)
+    writer.write(frame(f"register,{name}"))
+    await reader.readuntil(DELIMITER)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def run_churn(srv_host, srv_port, server_pid, n_cycles, concurrency, n_samples=10):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def cycle(i):
+        async with limit:
+            await churn_once(srv_host, srv_port, f"churn-{i}")
+
+    samples = []
+    start = time.perf_counter()
+    last_cpu = cpu_s(server_pid)
+    step = max(1, n_cycles // n_samples)
+    for done in range(0, n_cycles, step):
+        upto = min(n_cycles, done + step)
+        await asyncio.gather(*(cycle(i) for i in range(done, upto)))
+        cpu = cpu_s(server_pid)
+        samples.append(
+            {
+                "cycles": upto,
+                "server_cpu_ms_per_cycle": (cpu - last_cpu) * 1000 / (upto - done),
+                "server_rss_kb": rss_kb(server_pid),
+            }
+        )
+        last_cpu = cpu
+    elapsed = time.perf_counter() - start
+
+    # Let the server notice the last disconnects, then check it has nothing left to do
+    await asyncio.sleep(1)
+    idle_from = cpu_s(server_pid)
+    await asyncio.sleep(2)
+    idle_cpu_pct = (cpu_s(server_pid) - idle_from) / 2 * 100
+    return elapsed, samples, idle_cpu_pct, await query_stats(srv_host, srv_port)
+
+
+def churn(kind, n_cycles, concurrency=100, port=None):
+    port = port or free_port()
+    server, probe = start_server(kind, port)
+    try:
+        elapsed, samples, idle_cpu_pct, gauges = asyncio.run(
+            run_churn("127.0.0.1", port, server.pid, n_cycles, concurrency)
+        )
+    finally:
+        server.terminate()
+        server.join()
+        probe.close()
+
+    return {
+        "server": kind,
+        "commit": current_commit(),
+        "cycles": n_cycles,
+        "cycles_per_s": n_cycles / elapsed,
+        "samples": samples,
+        "idle_cpu_pct_after": idle_cpu_pct,
+        # Taken over a fresh connection, so live counts it and the readiness probe
+        "gauges": gauges,
+    }
+
+
+async def run_offline(srv_host, srv_port, n_msgs, batch_size=100):
+    reader, writer = await asyncio.open_connection(srv_host, srv_port)
+    writer.write(frame("register,load-sender"))
+    await reader.readuntil(DELIMITER)
+
+    start = time.perf_counter()
+    for sent in range(0, n_msgs, batch_size):
+        writer.write(
+            b"".join(
+                frame(f"tell,load-absent,{i} Call me, maybe?")
+                for i in range(sent, min(n_msgs, sent + batch_size))
+            )
+        )
+        await writer.drain()
+    # Commands are handled in order, so once this is answered every tell is in the log
+    writer.write(frame("stats"))
+    await reader.readuntil(DELIMITER)
+    append_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reader, absent = await asyncio.open_connection(srv_host, srv_port)
+    absent.write(frame("register,load-absent"))
+    # The ack, then the whole backlog
+    received = 0
+    while received < n_msgs + 1 and (data := await reader.read(1 << 20)):
+        received += data.count(DELIMITER)
+    replay_s = time.perf_counter() - start
+    writer.close()
+    absent.close()
+    return append_s, replay_s, received - 1
+
+
+def offline(kind, n_msgs, port=None):
+    port = port or free_port()
+    log_dir = tempfile.mkdtemp(prefix="chat-log-")
+    server, probe = start_server(kind, port, log_dir)
+    try:
+        append_s, replay_s, replayed = asyncio.run(run_offline("127.0.0.1", port, n_msgs))
+        server_rss_kb = rss_kb(server.pid)
+    finally:
+        server.terminate()
+        server.join()
+        probe.close()
+        shutil.rmtree(log_dir)
+
+    return {
+        "server": kind,
+        "commit": current_commit(),
+        "messages": n_msgs,
+        "append_msgs_per_s": n_msgs / append_s,
+        "replayed": replayed,
+        "replay_s": replay_s,
+        "replay_msgs_per_s": replayed / replay_s,
+        "server_rss_kb": server_rss_kb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("server", choices=sorted(SERVERS))
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=2000, help="total msgs/s across all clients")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--msg-size", type=int, default=0, help="bytes of padding per message")
+    parser.add_argument("--concurrency", type=int, default=100, help="connections opened at once")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--protocol", choices=sorted(CLIENTS), default="text")
+    parser.add_argument("--churn", type=int, help="connect and disconnect this many times instead")
+    parser.add_argument(
+        "--offline", type=int, help="store this many tells for an absent user, then replay them"
+    )
+    args = parser.parse_args()
+    if args.churn:
+        print(json.dumps(churn(args.server, args.churn, args.concurrency, args.port), indent=2))
+        return
+    if args.offline:
+        print(json.dumps(offline(args.server, args.offline, args.port), indent=2))
+        return
+    report = run(
+        args.server,
+        args.clients,
+        args.rate,
+        args.duration,
+        args.msg_size,
+        args.concurrency,
+        args.port,
+        args.protocol,
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
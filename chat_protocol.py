@@ -0,0 +1,241 @@
+"""Framing and connection bookkeeping shared by the chat servers and their clients.
+
+Connections speak newline-delimited text unless their first byte is
+BINARY_MAGIC, in which case every frame after it is a fixed HEADER (op, user
+ID, payload length) followed by the payload. Binary clients address users by
+the small integer ID the server hands out on register, and the server forwards
+tell payloads without ever decoding them.
+"""
+from collections import deque
+from enum import Enum
+from struct import Struct
+
+DELIMITER = b"\n"
+# The longest frame payload either protocol takes from a client
+MAX_PAYLOAD = 1 << 20
+
+
+def frame(text):
+    if "\n" in text:
+        raise ValueError(f"chat frames can't contain newlines: {text!r}")
+    return text.encode() + DELIMITER
+
+
+# Servers ping a connection that has gone quiet; clients answer with a pong,
+# and a peer that stays silent past the idle timeout is evicted.
+PING = frame("ping")
+PONG = frame("pong")
+
+
+class FrameParser:
+    """Splits a byte stream into frames, holding any trailing partial frame for the next feed.
+
+    Only complete frames are decoded, and each exactly once, however the
+    stream was chunked: one read may carry many pipelined commands or a
+    fraction of one. Like a binary payload, a frame is capped, at MAX_PAYLOAD
+    unless max_frame says otherwise.
+    """
+
+    def __init__(self, max_frame=MAX_PAYLOAD):
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        # Everything before this offset has already been searched for a delimiter
+        self.scanned = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        end = buffer.rfind(DELIMITER, self.scanned)
+        if end < 0:
+            if len(buffer) > self.max_frame:
+                raise FrameError(f"text frame runs past {self.max_frame} bytes without a delimiter")
+            # Keep a frame arriving in small pieces linear: next time, only
+            # search what's new
+            self.scanned = max(0, len(buffer) - len(DELIMITER) + 1)
+            return []
+        frames = buffer[:end].split(DELIMITER)
+        del buffer[: end + len(DELIMITER)]
+        self.scanned = 0
+        # A stray non-UTF-8 byte spoils only its own command, not the stream
+        return [frame.decode(errors="replace") for frame in frames]
+
+
+BINARY_MAGIC = b"\x00"
+HEADER = Struct("!BHI")
+(
+    OP_REGISTER,
+    OP_ACK,
+    OP_LOOKUP,
+    OP_USER,
+    OP_UNKNOWN,
+    OP_TELL,
+    OP_PING,
+    OP_PONG,
+    OP_ERROR,
+) = range(1, 10)
+# What the servers' command handlers raise on a malformed command; it's
+# answered with error_frame and the connection carries on
+BAD_COMMAND = (ValueError, IndexError)
+
+
+class FrameError(ValueError):
+    """A stream that can't be split into frames any more; the connection has to go."""
+
+
+def pack(op, user_id=0, payload=b""):
+    return HEADER.pack(op, user_id, len(payload)) + payload
+
+
+BINARY_PING = pack(OP_PING)
+BINARY_PONG = pack(OP_PONG)
+
+
+class BinaryParser:
+    """Splits a byte stream into (op, user_id, payload) frames, holding any partial frame."""
+
+    def __init__(self):
+        self.partial = b""
+
+    def feed(self, data):
+        buffer = self.partial + data if self.partial else data
+        frames = []
+        unpack_from, size, end_of_buffer = HEADER.unpack_from, HEADER.size, len(buffer)
+        offset = 0
+        while end_of_buffer - offset >= size:
+            op, user_id, length = unpack_from(buffer, offset)
+            if length > MAX_PAYLOAD:
+                raise FrameError(f"binary frame payload of {length} bytes is too large")
+            end = offset + size + length
+            if end > end_of_buffer:
+                break
+            frames.append((op, user_id, buffer[offset + size : end]))
+            offset = end
+        self.partial = buffer[offset:]
+        return frames
+
+
+def detect_protocol(data):
+    """Picks a connection's protocol from the first bytes it sends.
+
+    Returns whether it's binary, a parser for it, and data less BINARY_MAGIC.
+    """
+    # Text commands start with a letter, so one byte settles the protocol
+    if data[:1] == BINARY_MAGIC:
+        return True, BinaryParser(), data[len(BINARY_MAGIC) :]
+    return False, FrameParser(), data
+
+
+def lookup_reply(conn, name):
+    """Answers an OP_LOOKUP for name, the raw payload, given the connection registered under it, if any."""
+    if conn is None:
+        return pack(OP_UNKNOWN, 0, name)
+    return pack(OP_USER, conn.user_id, name)
+
+
+def error_frame(binary, reason):
+    return pack(OP_ERROR, 0, reason.encode()) if binary else frame(f"error: {reason}")
+
+
+def tell_frame(binary, sender, sender_id, body):
+    # body is bytes from binary senders and str from text ones; it's only
+    # transcoded when the recipient speaks the other protocol. Binary tells
+    # are routed by ID and forwarded as the same bytes; only the header is
+    # rewritten
+    if binary:
+        return pack(OP_TELL, sender_id, body if isinstance(body, bytes) else body.encode())
+    if isinstance(body, bytes):
+        body = payload_text(body)
+    return frame(f"{sender}: {body}")
+
+
+def payload_text(payload):
+    # Binary payloads are arbitrary bytes, but a text frame must be UTF-8 and
+    # can't hold its own delimiter
+    return payload.decode(errors="replace").replace("\n", "\\n")
+
+
+class UserTable:
+    """Interns user names as IDs 1..capacity, routing on a table allocated up front.
+
+    An ID is recycled once its user disconnects; 0 never names anyone.
+    """
+
+    def __init__(self, capacity=(1 << 16) - 1):
+        self.conns = [None] * (capacity + 1)
+        self.ids = {}
+        self.free = deque(range(1, capacity + 1))
+
+    def add(self, name, conn):
+        user_id = self.ids.get(name)
+        if user_id is None:
+            if not self.free:
+                raise ValueError(f"no user IDs left for {name}")
+            user_id = self.ids[name] = self.free.popleft()
+        self.conns[user_id] = conn
+        return user_id
+
+    def remove(self, name, user_id, conn):
+        # A user who has since re-registered on another connection keeps the ID
+        if self.conns[user_id] is conn:
+            self.conns[user_id] = None
+            del self.ids[name]
+            self.free.append(user_id)
+
+    def get(self, user_id):
+        return self.conns[user_id] if user_id < len(self.conns) else None
+
+
+class ConnectionStats:
+    """Connection gauges, reported to clients in reply to the stats command."""
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.evicted = 0
+
+    @property
+    def live(self):
+        return self.opened - self.closed
+
+    def report(self, registered):
+        return (
+            f"live={self.live} registered={registered} opened={self.opened} "
+            f"closed={self.closed} evicted={self.evicted}"
+        )
+
+
+class Idle(Enum):
+    ACTIVE = "active"
+    PING = "ping"
+    EVICT = "evict"
+
+
+class IdlePolicy:
+    """When a server pings a quiet connection, and when it gives up on one.
+
+    Connections quiet for heartbeat_s get pinged, and are evicted once nothing
+    at all has arrived for idle_timeout_s; None turns either off. Half-open
+    peers never send a FIN, so silence is all there is to go on.
+    """
+
+    def __init__(self, heartbeat_s=30, idle_timeout_s=90):
+        self.heartbeat_s = heartbeat_s
+        self.idle_timeout_s = idle_timeout_s
+        # How often to check connections, or None if there's nothing to check for
+        self.interval = min((t for t in (heartbeat_s, idle_timeout_s) if t), default=None)
+
+    def check(self, last_seen, now):
+        idle = now - last_seen
+        if self.idle_timeout_s and idle >= self.idle_timeout_s:
+            return Idle.EVICT
+        if self.heartbeat_s and idle >= self.heartbeat_s:
+            return Idle.PING
+        return Idle.ACTIVE
+
+
+def ping_frame(binary):
+    return BINARY_PING if binary else PING
+
+
+def parse_stats(msg):
+    return {key: int(value) for key, value in (field.split("=") for field in msg.split())}
@@ -1,22 +1,319 @@
 import asyncio
 import random
+import socket
+import sys
 import time
+from collections import defaultdict, deque
+from enum import Enum
 from threading import current_thread
 
+from chat_protocol import (
+    BAD_COMMAND,
+    BINARY_MAGIC,
+    OP_ACK,
+    OP_LOOKUP,
+    OP_PONG,
+    OP_REGISTER,
+    OP_TELL,
+    OP_UNKNOWN,
+    PONG,
+    BinaryParser,
+    ConnectionStats,
+    FrameError,
+    FrameParser,
+    Idle,
+    IdlePolicy,
+    UserTable,
+    detect_protocol,
+    error_frame,
+    frame,
+    lookup_reply,
+    pack,
+    ping_frame,
+    tell_frame,
+)
+
+
+class FullPolicy(Enum):
+    DROP_OLDEST = "drop_oldest"
+    DISCONNECT = "disconnect"
+    BLOCK = "block"
+
+
+class Connection:
+    def __init__(self, writer, outbox_size):
+        self.writer = writer
+        self.user = None
+        self.user_id = 0
+        self.binary = False
+        self.rooms = set()
+        # Everything bound for this client goes through here; only its own
+        # writer task ever awaits drain(), so a slow reader stalls nobody else.
+        self.outbox = asyncio.Queue(outbox_size)
+        self.writer_task = None
+        self.dropped = 0
+        self.closed = False
+        self.last_seen = time.monotonic()
+
+
+class WriteStats:
+    def __init__(self):
+        self.writes = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def record(self, messages, nbytes):
+        self.writes += 1
+        self.messages += messages
+        self.bytes += nbytes
+
+    @property
+    def msgs_per_write(self):
+        return self.messages / self.writes if self.writes else 0
+
+    @property
+    def bytes_per_write(self):
+        return self.bytes / self.writes if self.writes else 0
+
 
 class ChatServerAsync:
-    def __init__(self, port):
+    def __init__(
+        self,
+        port,
+        verbose=True,
+        outbox_size=1024,
+        full_policy=FullPolicy.DROP_OLDEST,
+        sndbuf=None,
+        coalesce_bytes=64 * 1024,
+        coalesce_delay_s=0,
+        heartbeat_s=30,
+        idle_timeout_s=90,
+        message_log=None,
+    ):
         self.port = port
+        self.verbose = verbose
+        self.outbox_size = outbox_size
+        self.full_policy = full_policy
+        # Caps what the kernel buffers per client, so backpressure reaches the outbox sooner
+        self.sndbuf = sndbuf
+        # A connection's queued messages go out as one writelines() of up to
+        # coalesce_bytes; waiting coalesce_delay_s first trades latency for bigger
+        # batches. coalesce_bytes=0 writes every message on its own.
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_delay_s = coalesce_delay_s
+        self.idle = IdlePolicy(heartbeat_s, idle_timeout_s)
+        self.reaper = None
+        # With a MessageLog, tells to anyone offline wait there until they register
+        self.message_log = message_log
+        self.write_stats = WriteStats()
+        self.conn_stats = ConnectionStats()
         self.clients = {}
-        self.writers = {}
+        self.users = UserTable()
+        self.connections = {}
+        self.rooms = defaultdict(set)
 
     async def run_server(self, reader, writer):
+        if self.sndbuf is not None:
+            sock = writer.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        conn = Connection(writer, self.outbox_size)
+        self.connections[writer] = conn
+        self.conn_stats.opened += 1
+        conn.writer_task = asyncio.create_task(self.write_outbox(conn))
+        if self.reaper is None and self.idle.interval:
+            self.reaper = asyncio.create_task(self.reap_idle())
+        parser = None
+        try:
+            while not conn.closed:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                conn.last_seen = time.monotonic()
+                if parser is None:
+                    conn.binary, parser, data = detect_protocol(data)
+                # A read may hold several pipelined commands, or only part of one
+                for command in parser.feed(data):
+                    await self.handle(conn, command)
+        except ConnectionError:
+            pass
+        except FrameError as e:
+            print(f"{conn.user} sent a bad frame ({e}); disconnecting")
+        finally:
+            self.disconnect(conn)
+
+    async def handle(self, conn, command):
+        try:
+            if conn.binary:
+                await self.handle_binary(*command, conn)
+                return
+            if self.verbose:
+                print(f"[{current_thread().getName()}] Server received {command}")
+            await self.handle_client(command, conn)
+        except BAD_COMMAND as e:
+            print(f"{conn.user} sent a bad command {command!r}: {e}")
+            await self.send(conn, error_frame(conn.binary, f"bad command: {e}"))
+
+    async def reap_idle(self):
         while True:
-            msg = (await reader.read(4096)).decode()
-            print(f"[{current_thread().getName()}] Server received {msg}")
-            await self.handle_client(msg, writer)
+            await asyncio.sleep(self.idle.interval)
+            now = time.monotonic()
+            for conn in list(self.connections.values()):
+                state = self.idle.check(conn.last_seen, now)
+                if state is Idle.EVICT:
+                    if self.verbose:
+                        print(f"{conn.user} has been idle for {now - conn.last_seen:.0f}s; evicting")
+                    self.conn_stats.evicted += 1
+                    self.disconnect(conn)
+                elif state is Idle.PING:
+                    # A full outbox already has plenty to provoke an error from a dead peer
+                    try:
+                        conn.outbox.put_nowait(ping_frame(conn.binary))
+                    except asyncio.QueueFull:
+                        pass
 
-    async def handle_client(self, msg, writer):
+    async def write_outbox(self, conn):
+        outbox = conn.outbox
+        batch = []
+        try:
+            while True:
+                batch = [await outbox.get()]
+                nbytes = len(batch[0])
+                if nbytes < self.coalesce_bytes:
+                    # Let the rest of this tick (or the delay) queue up more behind it
+                    await asyncio.sleep(self.coalesce_delay_s)
+                while nbytes < self.coalesce_bytes and not outbox.empty():
+                    data = outbox.get_nowait()
+                    batch.append(data)
+                    nbytes += len(data)
+                conn.writer.writelines(batch)
+                self.write_stats.record(len(batch), nbytes)
+                await conn.writer.drain()
+                if self.message_log is not None:
+                    self.message_log.delivered(batch)
+                batch = []
+        except ConnectionError:
+            self.disconnect(conn)
+        finally:
+            if self.message_log is not None:
+                # Whatever was in hand when the connection went stays in the log
+                self.message_log.requeue(batch)
+
+    async def send(self, conn, data):
+        if conn.closed:
+            return
+        try:
+            conn.outbox.put_nowait(data)
+        except asyncio.QueueFull:
+            if self.full_policy is FullPolicy.BLOCK:
+                await conn.outbox.put(data)
+            elif self.full_policy is FullPolicy.DROP_OLDEST:
+                oldest = conn.outbox.get_nowait()
+                if self.message_log is not None:
+                    self.message_log.requeue((oldest,))
+                conn.dropped += 1
+                conn.outbox.put_nowait(data)
+            else:
+                if self.verbose:
+                    print(f"{conn.user} isn't keeping up; disconnecting")
+                self.disconnect(conn)
+
+    async def send_to_all(self, conns, data):
+        # data is encoded once by the caller and the same bytes are queued for everyone
+        for conn in conns:
+            await self.send(conn, data)
+
+    def disconnect(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.connections.pop(conn.writer, None)
+        self.conn_stats.closed += 1
+        if conn.user_id:
+            self.users.remove(conn.user, conn.user_id, conn)
+        if self.clients.get(conn.user) is conn:
+            del self.clients[conn.user]
+            self.unregistered(conn.user)
+        for room in conn.rooms:
+            self.rooms[room].discard(conn)
+            if not self.rooms[room]:
+                del self.rooms[room]
+        conn.writer_task.cancel()
+        conn.writer.close()
+        # Nothing will drain the outbox now, so free its space for anyone blocked on put()
+        unsent = []
+        while not conn.outbox.empty():
+            unsent.append(conn.outbox.get_nowait())
+        if self.message_log is not None:
+            self.message_log.requeue(unsent)
+
+    # Hooks for servers that share their users with other processes
+    def registered(self, user):
+        pass
+
+    def unregistered(self, user):
+        pass
+
+    def user_names(self):
+        return self.clients.keys()
+
+    async def tell(self, conn, recipient, msg):
+        recp_conn = self.clients.get(recipient)
+        if recp_conn is not None:
+            await self.send(recp_conn, tell_frame(recp_conn.binary, conn.user, conn.user_id, msg))
+        elif self.message_log is not None:
+            # Straight on the loop: it's a copy into already-mapped pages, bar
+            # a new segment file now and then, and from an executor it could
+            # land after the recipient has registered and replayed its backlog
+            self.message_log.append(recipient, conn.user, msg)
+        else:
+            await self.send(conn, frame(f"Unkown user: {recipient}"))
+
+    async def register(self, conn, user):
+        if conn.user_id:
+            # Registering again under a new name lets go of the old one
+            self.users.remove(conn.user, conn.user_id, conn)
+            if self.clients.get(conn.user) is conn:
+                del self.clients[conn.user]
+                self.unregistered(conn.user)
+        conn.user = user
+        conn.user_id = self.users.add(user, conn)
+        self.clients[user] = conn
+        self.registered(user)
+        if self.verbose:
+            print(f"{user} has joined the chat")
+        await self.send(conn, pack(OP_ACK, conn.user_id) if conn.binary else frame("ack"))
+        if self.message_log is not None:
+            await self.replay(conn)
+
+    async def replay(self, conn):
+        # Paced by the writer rather than the full policy: nobody else is waiting
+        # on this backlog, so there's no reason to drop any of it
+        backlog = self.message_log.replay(conn.user, conn.binary)
+        for chunk in backlog:
+            await conn.outbox.put(chunk)
+            if conn.closed:
+                # disconnect() emptied the outbox before this chunk went in, and
+                # closing hands whatever's left back to the log
+                self.message_log.requeue((chunk,))
+                backlog.close()
+
+    async def handle_binary(self, op, user_id, payload, conn):
+        if op == OP_TELL:
+            recp_conn = self.users.get(user_id)
+            if recp_conn is None:
+                await self.send(conn, pack(OP_UNKNOWN, user_id))
+            else:
+                await self.send(
+                    recp_conn, tell_frame(recp_conn.binary, conn.user, conn.user_id, payload)
+                )
+        elif op == OP_REGISTER:
+            await self.register(conn, payload.decode())
+        elif op == OP_LOOKUP:
+            await self.send(conn, lookup_reply(self.clients.get(payload.decode()), payload))
+        elif op == OP_PONG:
+            pass
+
+    async def handle_client(self, msg, conn):
         try:
             cmd, *params = msg.split(",", 1)
         except Exception as e:
@@ -25,24 +322,37 @@ class ChatServerAsync:
 
         if cmd == "register":
             [user] = params
-            self.clients[user] = writer
-            self.writers[writer] = user
-            print(f"{user} has joined the chat")
-            writer.write("ack".encode())
-            await writer.drain()
+            await self.register(conn, user)
         elif cmd == "list":
-            names = self.clients.keys()
-            writer.write((", ".join(names) + "\n").encode())
-            await writer.drain()
+            await self.send(conn, frame(", ".join(self.user_names())))
+        elif cmd == "pong":
+            # Any traffic refreshes last_seen; a pong just has nothing else to say
+            pass
+        elif cmd == "stats":
+            await self.send(conn, frame(self.conn_stats.report(len(self.clients))))
         elif cmd == "tell":
             recipient, msg = params[0].split(",", 1)
-            recp_writer = self.clients.get(recipient)
-            if recp_writer is None:
-                writer.write(f"Unkown user: {recipient}".encode())
-                await writer.drain()
-            else:
-                recp_writer.write(f"{self.writers[writer]}: {msg}".encode())
-                await recp_writer.drain()
+            await self.tell(conn, recipient, msg)
+        elif cmd == "join":
+            [room] = params
+            self.rooms[room].add(conn)
+            conn.rooms.add(room)
+            await self.send(conn, frame("ack"))
+        elif cmd == "leave":
+            [room] = params
+            self.rooms[room].discard(conn)
+            if not self.rooms[room]:
+                del self.rooms[room]
+            conn.rooms.discard(room)
+            await self.send(conn, frame("ack"))
+        elif cmd == "room":
+            room, msg = params[0].split(",", 1)
+            members = [member for member in self.rooms.get(room, ()) if member is not conn]
+            await self.send_to_all(members, frame(f"{conn.user}@{room}: {msg}"))
+        elif cmd == "broadcast":
+            [msg] = params
+            others = [other for other in self.clients.values() if other is not conn]
+            await self.send_to_all(others, frame(f"{conn.user}@all: {msg}"))
 
 
 class User:
@@ -59,30 +369,46 @@ class User:
         self.srv_host = srv_host
         self.srv_port = srv_port
 
-    async def recv_msg(self, reader):
+    async def recv_msg(self, reader, writer):
         while True:
-            msg = (await reader.read(4096)).decode()
+            try:
+                msg = await self.recv_frame(reader)
+            except ConnectionError:
+                print(f"{self.name} was disconnected")
+                return
+            if msg == "ping":
+                writer.write(PONG)
+                continue
             print(f"[{current_thread().getName()}] {self.name} received: {msg}\n")
 
+    async def recv_frame(self, reader):
+        while not self.pending:
+            if not (data := await reader.read(65536)):
+                raise ConnectionError("server closed the connection")
+            self.pending.extend(self.parser.feed(data))
+        return self.pending.popleft()
+
     # Dummy client that just sends a few canned commands
     async def run_client(self):
         reader, writer = await asyncio.open_connection(self.srv_host, self.srv_port)
+        self.parser = FrameParser()
+        self.pending = deque()
 
-        writer.write(f"register,{self.name}".encode())
+        writer.write(frame(f"register,{self.name}"))
         await writer.drain()
         print(f"{self.name} is registering")
-        await reader.read(4096)
+        await self.recv_frame(reader)
 
-        writer.write("list,all".encode())
+        writer.write(frame("list,all"))
         await writer.drain()
-        users = (await reader.read(4096)).decode().split(", ")
+        users = (await self.recv_frame(reader)).split(", ")
 
-        asyncio.create_task(self.recv_msg(reader))
+        asyncio.create_task(self.recv_msg(reader, writer))
 
         while True:
             recp = random.choice(users)
             msg = random.choice(self.THINGS_TO_SAY)
-            writer.write(f"tell,{recp},{msg}".encode())
+            writer.write(frame(f"tell,{recp},{msg}"))
             await writer.drain()
             await asyncio.sleep(random.randint(3, 7))
 
@@ -111,5 +437,271 @@ async def main():
     await asyncio.gather(*tasks)
 
 
+async def register_client(name, srv_host, srv_port):
+    reader, writer = await asyncio.open_connection(srv_host, srv_port)
+    parser = FrameParser()
+    writer.write(frame(f"register,{name}"))
+    await writer.drain()
+    while not parser.feed(data := await reader.read(4096)):
+        if not data:
+            raise ConnectionError(f"server closed {name}'s connection")
+    return reader, writer, parser
+
+
+async def count_received(reader, parser, expected):
+    received = len(parser.feed(b""))
+    while received < expected:
+        if not (data := await reader.read(65536)):
+            raise ConnectionError(f"server closed the connection after {received}/{expected}")
+        received += len(parser.feed(data))
+
+
+async def send_tells(writer, peers, n_msgs, batch_size):
+    for start in range(0, n_msgs, batch_size):
+        # batch_size frames go out in a single write; 1 is the old one-command-per-write client
+        writer.write(
+            b"".join(
+                frame(f"tell,{random.choice(peers)},Call me, maybe?")
+                for _ in range(min(batch_size, n_msgs - start))
+            )
+        )
+        await writer.drain()
+
+
+async def run_bench(n_clients, n_msgs, batch_size):
+    srv_host = "127.0.0.1"
+    srv = ChatServerAsync(0, verbose=False)
+    server = await asyncio.start_server(srv.run_server, srv_host, 0)
+    srv_port = server.sockets[0].getsockname()[1]
+
+    names = [f"user-{i}" for i in range(n_clients)]
+    clients = [await register_client(name, srv_host, srv_port) for name in names]
+    # Every client sends to itself, so each knows exactly how many frames to expect
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(send_tells(writer, [name], n_msgs, batch_size) for name, (_, writer, _) in zip(names, clients)),
+        *(count_received(reader, parser, n_msgs) for reader, _, parser in clients),
+    )
+    elapsed = time.perf_counter() - start
+    server.close()
+    return n_clients * n_msgs / elapsed
+
+
+async def run_fan_out_bench(coalesce_bytes, coalesce_delay_s, n_clients, n_msgs):
+    srv_host = "127.0.0.1"
+    # BLOCK so nothing is dropped and every client can count to the expected total
+    srv = ChatServerAsync(
+        0,
+        verbose=False,
+        full_policy=FullPolicy.BLOCK,
+        coalesce_bytes=coalesce_bytes,
+        coalesce_delay_s=coalesce_delay_s,
+    )
+    server = await asyncio.start_server(srv.run_server, srv_host, 0)
+    srv_port = server.sockets[0].getsockname()[1]
+
+    clients = []
+    for i in range(n_clients):
+        reader, writer, parser = await register_client(f"user-{i}", srv_host, srv_port)
+        writer.write(frame("join,lobby"))
+        while not parser.feed(data := await reader.read(4096)):
+            if not data:
+                raise ConnectionError(f"server closed user-{i}'s connection")
+        clients.append((reader, writer, parser))
+
+    async def chatter(writer):
+        for _ in range(n_msgs):
+            writer.write(frame("room,lobby,Call me, maybe?"))
+            await writer.drain()
+
+    expected = n_msgs * (n_clients - 1)
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(chatter(writer) for _, writer, _ in clients),
+        *(count_received(reader, parser, expected) for reader, _, parser in clients),
+    )
+    elapsed = time.perf_counter() - start
+    server.close()
+    return n_clients * expected / elapsed, srv.write_stats.writes / elapsed, srv.write_stats
+
+
+def bench_coalescing(n_clients=50, n_msgs=200):
+    for coalesce_bytes, coalesce_delay_s in ((0, 0), (64 * 1024, 0), (64 * 1024, 0.001)):
+        rate, writes_per_s, stats = asyncio.run(
+            run_fan_out_bench(coalesce_bytes, coalesce_delay_s, n_clients, n_msgs)
+        )
+        print(
+            f"coalesce_bytes={coalesce_bytes:<6} delay={coalesce_delay_s * 1000:3.0f}ms {rate:>9,.0f} msgs/s {writes_per_s:>9,.0f} writes/s "
+            f"{stats.msgs_per_write:6.1f} msgs/write {stats.bytes_per_write:8.0f} bytes/write"
+        )
+
+
+def bench(n_clients=100, n_msgs=500):
+    for batch_size in (1, 10, 100):
+        rate = asyncio.run(run_bench(n_clients, n_msgs, batch_size))
+        print(f"{n_clients} clients, {batch_size:>3} tells per write: {rate:>9,.0f} msgs/s")
+
+
+async def register_binary_client(name, srv_host, srv_port):
+    reader, writer = await asyncio.open_connection(srv_host, srv_port)
+    parser = BinaryParser()
+    writer.write(BINARY_MAGIC + pack(OP_REGISTER, 0, name.encode()))
+    await writer.drain()
+    while not (frames := parser.feed(data := await reader.read(4096))):
+        if not data:
+            raise ConnectionError(f"server closed {name}'s connection")
+    [(_, user_id, _)] = frames
+    return reader, writer, parser, user_id
+
+
+async def run_protocol_bench(binary, n_clients, n_msgs, batch_size):
+    srv_host = "127.0.0.1"
+    srv = ChatServerAsync(0, verbose=False, full_policy=FullPolicy.BLOCK)
+    server = await asyncio.start_server(srv.run_server, srv_host, 0)
+    srv_port = server.sockets[0].getsockname()[1]
+
+    body = "Call me, maybe?"
+    clients = []
+    for i in range(n_clients):
+        name = f"user-{i}"
+        if binary:
+            reader, writer, parser, user_id = await register_binary_client(name, srv_host, srv_port)
+            tell = delivered = pack(OP_TELL, user_id, body.encode())
+        else:
+            reader, writer, parser = await register_client(name, srv_host, srv_port)
+            tell, delivered = frame(f"tell,{name},{body}"), frame(f"{name}: {body}")
+        clients.append((reader, writer, parser, tell))
+
+    async def sender(writer, tell):
+        for _ in range(n_msgs // batch_size):
+            writer.write(tell * batch_size)
+            await writer.drain()
+
+    n_each = n_msgs // batch_size * batch_size
+    start, start_cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(
+        *(sender(writer, tell) for _, writer, _, tell in clients),
+        *(count_received(reader, parser, n_each) for reader, _, parser, _ in clients),
+    )
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    server.close()
+    total = n_clients * n_each
+    return total / elapsed, cpu * 1e6 / total, len(tell) + len(delivered)
+
+
+def bench_protocols(n_clients=100, n_msgs=2000, batch_size=100):
+    # Clients share the process, so CPU covers both ends; pipelining keeps syscalls out of it
+    for binary in (False, True):
+        rate, cpu_us, wire_bytes = asyncio.run(
+            run_protocol_bench(binary, n_clients, n_msgs, batch_size)
+        )
+        print(
+            f"{'binary' if binary else 'text':<6} {rate:>9,.0f} msgs/s {cpu_us:6.2f} us CPU/msg {wire_bytes:4} bytes/msg on the wire"
+        )
+
+
+async def open_client(srv_host, srv_port, rcvbuf=None):
+    sock = socket.socket()
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, (srv_host, srv_port))
+    return await asyncio.open_connection(sock=sock)
+
+
+async def timed_receiver(reader, latencies):
+    parser = FrameParser()
+    while data := await reader.read(65536):
+        for msg in parser.feed(data):
+            # "<sender>: <perf_counter at send> <padding>"; anything else is a server notice
+            sender, _, body = msg.partition(": ")
+            if sender.startswith("user-"):
+                latencies.append(time.perf_counter() - float(body.split(" ", 1)[0]))
+
+
+async def slow_receiver(reader):
+    while await reader.read(1024):
+        await asyncio.sleep(1)
+
+
+async def timed_sender(writer, names, slow_names, duration_s, rate_per_s, padding):
+    # Returns how many messages it addressed to clients that keep up
+    deadline = time.perf_counter() + duration_s
+    sent_fast = 0
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(random.expovariate(rate_per_s))
+        # The slow readers are popular, so their backlog actually builds up
+        recipient = random.choice(slow_names if random.random() < 0.5 else names)
+        sent_fast += recipient not in slow_names
+        writer.write(frame(f"tell,{recipient},{time.perf_counter():.6f} {padding}"))
+        await writer.drain()
+    return sent_fast
+
+
+async def run_slow_reader_bench(
+    full_policy, n_clients, slow_fraction, duration_s, rate_per_s, padding
+):
+    srv_host = "127.0.0.1"
+    srv = ChatServerAsync(
+        0, verbose=False, outbox_size=64, full_policy=full_policy, sndbuf=16384
+    )
+    server = await asyncio.start_server(srv.run_server, srv_host, 0)
+    srv_port = server.sockets[0].getsockname()[1]
+
+    names = [f"user-{i}" for i in range(n_clients)]
+    n_slow = int(n_clients * slow_fraction)
+    latencies = []
+    tasks = []
+    writers = []
+    for i, name in enumerate(names):
+        slow = i < n_slow
+        reader, writer = await open_client(srv_host, srv_port, rcvbuf=4096 if slow else None)
+        writer.write(frame(f"register,{name}"))
+        await reader.readuntil(b"\n")
+        writers.append(writer)
+        tasks.append(
+            asyncio.create_task(
+                slow_receiver(reader) if slow else timed_receiver(reader, latencies)
+            )
+        )
+
+    senders = [
+        timed_sender(writer, names, names[:n_slow], duration_s, rate_per_s, padding)
+        for writer in writers[n_slow:]
+    ]
+    sent_fast = sum(await asyncio.gather(*senders))
+    await asyncio.sleep(1)
+    for task in tasks:
+        task.cancel()
+    for writer in writers:
+        writer.close()
+    server.close()
+    dropped = sum(conn.dropped for conn in srv.connections.values())
+    disconnected = n_slow - sum(name in srv.clients for name in names[:n_slow])
+    return latencies, sent_fast, dropped, disconnected
+
+
+def bench_slow_readers(
+    n_clients=5000, slow_fraction=0.01, duration_s=10, rate_per_s=1, padding="x" * 1024
+):
+    for full_policy in FullPolicy:
+        latencies, sent_fast, dropped, disconnected = asyncio.run(
+            run_slow_reader_bench(
+                full_policy, n_clients, slow_fraction, duration_s, rate_per_s, padding
+            )
+        )
+        latencies.sort()
+        p50, p99 = (latencies[int(len(latencies) * pct)] for pct in (0.5, 0.99))
+        print(
+            f"{full_policy.value:<12} delivered={len(latencies):>6}/{sent_fast:<6} dropped={dropped:>5} disconnected={disconnected:>3} p50={p50 * 1000:7.1f}ms p99={p99 * 1000:7.1f}ms"
+        )
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.argv[1:] == ["bench"]:
+        bench()
+        bench_coalescing()
+        bench_slow_readers()
+        bench_protocols()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,353 @@
+import asyncio
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from base64 import b64decode, b64encode
+
+from chat_protocol import (
+    MAX_PAYLOAD,
+    OP_LOOKUP,
+    OP_TELL,
+    OP_UNKNOWN,
+    FrameParser,
+    frame,
+    lookup_reply,
+    pack,
+    payload_text,
+    tell_frame,
+)
+from chat_server_asnc import (
+    ChatServerAsync,
+    User,
+    count_received,
+    register_client,
+    send_tells,
+)
+
+
+class RemoteUser:
+    """Stands in for a user on another worker in the UserTable, so binary clients get an ID for them."""
+
+    def __init__(self, user):
+        self.user = user
+        self.user_id = 0
+
+
+class ShardedChatServer(ChatServerAsync):
+    """One of several ChatServerAsync processes sharing a port through SO_REUSEPORT.
+
+    The kernel spreads connections over the workers. Each worker keeps a replica
+    of which worker owns which user, kept in sync over Unix-socket links, and
+    forwards tells for users connected elsewhere down the owner's link.
+    Binary clients looking up such a user get a local ID for a RemoteUser, and
+    their tells to it go down the link base64-encoded.
+    """
+
+    def __init__(self, port, worker_id, n_workers, link_dir, host="127.0.0.1", **kwargs):
+        super().__init__(port, **kwargs)
+        self.host = host
+        self.worker_id = worker_id
+        self.n_workers = n_workers
+        self.link_dir = link_dir
+        self.owners = {}
+        self.links = {}
+        self.reconnects = {}
+
+    def link_path(self, worker_id):
+        return os.path.join(self.link_dir, f"worker-{worker_id}.sock")
+
+    async def serve(self, ready=None):
+        await asyncio.start_unix_server(self.run_link, self.link_path(self.worker_id))
+        server = await asyncio.start_server(
+            self.run_server, self.host, self.port, reuse_port=True
+        )
+        await self.connect_links()
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def connect_links(self):
+        for peer in range(self.n_workers):
+            if peer != self.worker_id:
+                await self.connect_link(peer)
+
+    async def connect_link(self, peer):
+        # Peers come up in any order; keep knocking until their socket exists
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(self.link_path(peer))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.05)
+        self.links[peer] = writer
+
+    async def reconnect_link(self, peer):
+        await self.connect_link(peer)
+        del self.reconnects[peer]
+        # A restarted peer knows nothing about who's connected here
+        for user in self.clients:
+            self.links[peer].write(frame(f"owner,{user},{self.worker_id}"))
+
+    def drop_link(self, peer):
+        link = self.links.pop(peer, None)
+        if link is None:
+            return
+        link.close()
+        # Its users will be announced again if it comes back
+        for user in [user for user, owner in self.owners.items() if owner == peer]:
+            del self.owners[user]
+            self.forget_remote(user)
+        if peer not in self.reconnects:
+            self.reconnects[peer] = asyncio.create_task(self.reconnect_link(peer))
+
+    async def send_link(self, peer, data):
+        """Writes data down peer's link; returns False if the link is down."""
+        link = self.links.get(peer)
+        if link is None:
+            return False
+        try:
+            link.write(data)
+            await link.drain()
+        except (ConnectionError, OSError):
+            self.drop_link(peer)
+            return False
+        return True
+
+    async def run_link(self, reader, writer):
+        # A forwarded tell is a client's whole frame with routing in front
+        parser = FrameParser(2 * MAX_PAYLOAD)
+        try:
+            while data := await reader.read(65536):
+                for msg in parser.feed(data):
+                    await self.handle_link(msg)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_link(self, msg):
+        cmd, params = msg.split(",", 1)
+        if cmd == "owner":
+            user, worker_id = params.rsplit(",", 1)
+            self.owners[user] = int(worker_id)
+        elif cmd == "gone":
+            user, worker_id = params.rsplit(",", 1)
+            # Ignore a stale goodbye if the user has since registered elsewhere
+            if self.owners.get(user) == int(worker_id):
+                del self.owners[user]
+                self.forget_remote(user)
+        elif cmd == "deliver":
+            origin, recipient, sender, text = params.split(",", 3)
+            await self.deliver(int(origin), recipient, sender, text)
+        elif cmd == "binary":
+            origin, recipient, sender, payload = params.split(",", 3)
+            await self.deliver(int(origin), recipient, sender, b64decode(payload))
+        elif cmd == "unknown":
+            recipient, sender = params.split(",", 1)
+            sender_conn = self.clients.get(sender)
+            if sender_conn is None:
+                pass
+            elif sender_conn.binary:
+                await self.send(sender_conn, pack(OP_UNKNOWN, self.users.ids.get(recipient, 0)))
+            else:
+                await self.send(sender_conn, frame(f"Unkown user: {recipient}"))
+
+    async def deliver(self, origin, recipient, sender, body):
+        recp_conn = self.clients.get(recipient)
+        if recp_conn is not None:
+            # User IDs are per worker, so binary recipients see remote senders as ID 0
+            await self.send(recp_conn, tell_frame(recp_conn.binary, sender, 0, body))
+        elif self.message_log is not None:
+            text = body if isinstance(body, str) else payload_text(body)
+            self.message_log.append(recipient, sender, text)
+        else:
+            # The sender's worker had a stale owner entry; the user has gone
+            await self.send_link(origin, frame(f"unknown,{recipient},{sender}"))
+
+    def remote_user(self, user):
+        # Interned on first lookup; forget_remote gives the ID back once the user leaves
+        remote = self.users.get(self.users.ids.get(user, 0))
+        if not isinstance(remote, RemoteUser):
+            remote = RemoteUser(user)
+            remote.user_id = self.users.add(user, remote)
+        return remote
+
+    def forget_remote(self, user):
+        user_id = self.users.ids.get(user)
+        if user_id is not None and isinstance(remote := self.users.get(user_id), RemoteUser):
+            self.users.remove(user, user_id, remote)
+
+    def broadcast_link(self, data):
+        for peer, link in list(self.links.items()):
+            if link.is_closing():
+                self.drop_link(peer)
+            else:
+                link.write(data)
+
+    def registered(self, user):
+        self.owners[user] = self.worker_id
+        self.broadcast_link(frame(f"owner,{user},{self.worker_id}"))
+
+    def unregistered(self, user):
+        if self.owners.get(user) == self.worker_id:
+            del self.owners[user]
+        self.broadcast_link(frame(f"gone,{user},{self.worker_id}"))
+
+    def user_names(self):
+        return self.owners.keys()
+
+    async def tell(self, conn, recipient, msg):
+        owner = self.owners.get(recipient)
+        if owner is None or owner == self.worker_id:
+            await super().tell(conn, recipient, msg)
+        elif not await self.send_link(
+            owner, frame(f"deliver,{self.worker_id},{recipient},{conn.user},{msg}")
+        ):
+            await self.send(conn, frame(f"Unkown user: {recipient}"))
+
+    async def handle_binary(self, op, user_id, payload, conn):
+        if op == OP_LOOKUP:
+            user = payload.decode()
+            if user not in self.clients and self.owners.get(user, self.worker_id) != self.worker_id:
+                await self.send(conn, lookup_reply(self.remote_user(user), payload))
+                return
+        elif op == OP_TELL and isinstance(recp := self.users.get(user_id), RemoteUser):
+            owner = self.owners.get(recp.user)
+            data = frame(
+                f"binary,{self.worker_id},{recp.user},{conn.user},{b64encode(payload).decode()}"
+            )
+            if owner is None or not await self.send_link(owner, data):
+                await self.send(conn, pack(OP_UNKNOWN, user_id))
+            return
+        await super().handle_binary(op, user_id, payload, conn)
+
+
+def run_worker(worker_id, n_workers, port, link_dir, ready, server_kwargs):
+    server = ShardedChatServer(port, worker_id, n_workers, link_dir, **server_kwargs)
+    asyncio.run(server.serve(ready))
+
+
+def launch(n_workers, port, **server_kwargs):
+    """Start n_workers ShardedChatServer processes on port; returns once all are accepting."""
+    link_dir = tempfile.mkdtemp(prefix="chat-links-")
+    ready = [multiprocessing.Event() for _ in range(n_workers)]
+    workers = [
+        multiprocessing.Process(
+            name=f"ChatWorker-{i}",
+            target=run_worker,
+            args=(i, n_workers, port, link_dir, ready[i], server_kwargs),
+            daemon=True,
+        )
+        for i in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for event in ready:
+        event.wait()
+    return workers, link_dir
+
+
+def shutdown(workers, link_dir):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+    shutil.rmtree(link_dir, ignore_errors=True)
+
+
+async def run_load(srv_port, proc_id, n_procs, n_clients, n_msgs, start_barrier):
+    srv_host = "127.0.0.1"
+    total = n_procs * n_clients
+    clients = [
+        await register_client(f"u{proc_id}-{i}", srv_host, srv_port)
+        for i in range(n_clients)
+    ]
+    await asyncio.get_running_loop().run_in_executor(None, start_barrier.wait)
+    # Give ownership updates a moment to reach every worker
+    await asyncio.sleep(0.2)
+
+    # Each client talks to the next one along a ring spanning every load process,
+    # so most tells cross workers and every client knows how many to expect.
+    def next_user(i):
+        g = (proc_id * n_clients + i + 1) % total
+        return f"u{g // n_clients}-{g % n_clients}"
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            send_tells(writer, [next_user(i)], n_msgs, 10)
+            for i, (_, writer, _) in enumerate(clients)
+        ),
+        *(count_received(reader, parser, n_msgs) for reader, _, parser in clients),
+    )
+    return time.perf_counter() - start
+
+
+def load_process(srv_port, proc_id, n_procs, n_clients, n_msgs, start_barrier, results):
+    elapsed = asyncio.run(
+        run_load(srv_port, proc_id, n_procs, n_clients, n_msgs, start_barrier)
+    )
+    results.put(elapsed)
+
+
+def bench(n_load_procs=2, n_clients=100, n_msgs=200):
+    worker_counts = sorted({1, 2, 4, os.cpu_count()})
+    print(f"{os.cpu_count()} cores available")
+    for n_workers in worker_counts:
+        srv_port = random.randint(10000, 55555)
+        workers, link_dir = launch(n_workers, srv_port, verbose=False)
+        start_barrier = multiprocessing.Barrier(n_load_procs)
+        results = multiprocessing.Queue()
+        load = [
+            multiprocessing.Process(
+                target=load_process,
+                args=(srv_port, i, n_load_procs, n_clients, n_msgs, start_barrier, results),
+            )
+            for i in range(n_load_procs)
+        ]
+        for proc in load:
+            proc.start()
+        elapsed = max(results.get() for _ in load)
+        for proc in load:
+            proc.join()
+        shutdown(workers, link_dir)
+        total = n_load_procs * n_clients * n_msgs
+        print(f"workers={n_workers:<3} {total / elapsed:>9,.0f} msgs/s")
+
+
+async def demo_clients(srv_host, srv_port):
+    users = [
+        "watermelonFIEND",
+        "thr34dpooL",
+        "st4cktr4c3",
+        "Alex",
+        "Karl",
+        "Spot",
+        "Henry",
+    ]
+    await asyncio.gather(
+        *(User(username, srv_host, srv_port).run_client() for username in users)
+    )
+
+
+def main(n_workers=4):
+    srv_port = random.randint(10000, 55555)
+    workers, link_dir = launch(n_workers, srv_port, verbose=False)
+    try:
+        asyncio.run(asyncio.wait_for(demo_clients("127.0.0.1", srv_port), 20))
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        shutdown(workers, link_dir)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bench"]:
+        bench()
+    else:
+        main()
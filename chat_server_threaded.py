@@ -1,53 +1,483 @@
 import random
+import selectors
 import socket
 import sys
 import time
-from threading import Lock, Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from queue import Full
+from threading import Lock, Thread, get_ident
+
+from blocking_queue import BlockingQueue
+from chat_protocol import (
+    BAD_COMMAND,
+    OP_ACK,
+    OP_LOOKUP,
+    OP_REGISTER,
+    OP_TELL,
+    OP_UNKNOWN,
+    PONG,
+    ConnectionStats,
+    FrameError,
+    FrameParser,
+    Idle,
+    IdlePolicy,
+    UserTable,
+    detect_protocol,
+    error_frame,
+    frame,
+    lookup_reply,
+    pack,
+    ping_frame,
+    tell_frame,
+)
+
+
+class Engine(Enum):
+    THREADS = "threads"
+    SELECTORS = "selectors"
+
+
+class Client:
+    def __init__(self, sock):
+        self.sock = sock
+        self.user = "unknown"
+        self.user_id = 0
+        self.binary = False
+        self.parser = None
+        self.last_seen = time.monotonic()
+        # The thread engine's queue for this client's writer thread, the only one
+        # that ever sends on the socket
+        self.outbox = None
+        # Set by the writer thread once a send has failed
+        self.broken = False
+        # Only used by the selectors engine, for whatever the socket wouldn't take
+        # yet, and for the rest of a backlog being replayed as that drains
+        self.outbuf = bytearray()
+        self.backlog = None
+        # Backlog chunks still in outbuf, by where in the stream each one ends
+        self.in_flight = deque()
+        self.drained = 0
+        self.closed = False
 
 
 class ChatServerThreaded:
-    def __init__(self, port):
+    # Commands the selectors engine hands to its worker pool rather than run on the loop
+    CPU_HEAVY = {"list"}
+
+    def __init__(
+        self,
+        port,
+        verbose=True,
+        heartbeat_s=30,
+        idle_timeout_s=90,
+        engine=Engine.THREADS,
+        backlog=128,
+        n_workers=2,
+        max_outbuf=1 << 20,
+        outbox_size=1024,
+        send_timeout_s=5,
+        message_log=None,
+    ):
         self.port = port
+        self.verbose = verbose
+        self.idle = IdlePolicy(heartbeat_s, idle_timeout_s)
+        # THREADS runs a thread per client; SELECTORS serves every client from
+        # one thread on non-blocking sockets, plus n_workers for CPU_HEAVY commands.
+        self.engine = engine
+        self.backlog = backlog
+        self.n_workers = n_workers
+        # A selectors client whose unsent output grows past this is disconnected
+        self.max_outbuf = max_outbuf
+        # With threads, a client whose outbox stays full for send_timeout_s is disconnected
+        self.outbox_size = outbox_size
+        self.send_timeout_s = send_timeout_s
+        # With a MessageLog, tells to anyone offline wait there until they register
+        self.message_log = message_log
+        self.selector = None
+        # Only taken to change the registry. clients is copy-on-write: it's replaced,
+        # never mutated, so tell and list read whichever snapshot is current without it.
         self.lock = Lock()
         self.clients = {}
+        self.users = UserTable()
+        self.conn_stats = ConnectionStats()
 
     def run_server(self):
         sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(("", self.port))
-        sock.listen(5)
+        sock.listen(self.backlog)
 
-        while True:
-            client_sock, addr = sock.accept()
-            Thread(target=self.handle_client, args=(client_sock,), daemon=True).start()
+        if self.engine is Engine.SELECTORS:
+            self.run_selector(sock)
+        else:
+            while True:
+                client_sock, addr = sock.accept()
+                Thread(target=self.handle_client, args=(client_sock,), daemon=True).start()
 
     def handle_client(self, client_sock):
-        user = "unknown"
+        client = Client(client_sock)
+        client.outbox = BlockingQueue(self.outbox_size)
+        Thread(target=self.write_outbox, args=(client,), daemon=True).start()
+        with self.lock:
+            self.conn_stats.opened += 1
+        client_sock.settimeout(self.idle.interval)
+
+        try:
+            while True:
+                try:
+                    data = client_sock.recv(65536)
+                except socket.timeout:
+                    if not self.check_idle(client):
+                        break
+                    continue
+                if not data:
+                    break
+                self.feed(client, data)
+        except OSError:
+            pass
+        except FrameError as e:
+            print(f"{client.user} sent a bad frame ({e}); disconnecting")
+        finally:
+            self.disconnect(client)
+
+    def check_idle(self, client):
+        """Pings or evicts client if it has gone quiet; returns whether it's still connected."""
+        now = time.monotonic()
+        state = self.idle.check(client.last_seen, now)
+        if state is Idle.EVICT:
+            if self.verbose:
+                print(f"{client.user} has been idle for {now - client.last_seen:.0f}s; evicting")
+            with self.lock:
+                self.conn_stats.evicted += 1
+            return False
+        if state is Idle.PING:
+            self.send(client, ping_frame(client.binary))
+        return True
+
+    def feed(self, client, data):
+        client.last_seen = time.monotonic()
+        if client.parser is None:
+            client.binary, client.parser, data = detect_protocol(data)
+        # A recv may hold several pipelined commands, or only part of one
+        for command in client.parser.feed(data):
+            if (
+                self.selector is not None
+                and not client.binary
+                and command.split(",", 1)[0] in self.CPU_HEAVY
+            ):
+                # Its reply may overtake replies to commands sent after it
+                self.workers.submit(self.handle, client, command)
+            else:
+                self.handle(client, command)
+
+    def handle(self, client, command):
+        try:
+            if client.binary:
+                self.handle_binary(*command, client)
+            else:
+                self.handle_msg(command, client)
+        except BAD_COMMAND as e:
+            print(f"{client.user} sent a bad command {command!r}: {e}")
+            self.send(client, error_frame(client.binary, f"bad command: {e}"))
+
+    def run_selector(self, listener):
+        listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ)
+        # Workers can't touch the buffers, so they queue their output and poke the loop awake
+        self.loop_thread = get_ident()
+        self.handoffs = deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.workers = ThreadPoolExecutor(self.n_workers, thread_name_prefix="ChatWorker")
 
+        sweep_s = self.idle.interval or 3600
+        next_sweep = time.monotonic() + sweep_s
+        while True:
+            for key, events in self.selector.select(max(0, next_sweep - time.monotonic())):
+                if key.fileobj is listener:
+                    self.accept_all(listener)
+                elif key.fileobj is self.wake_r:
+                    self.drain_handoffs()
+                elif not key.data.closed:
+                    # Delivering an earlier event's message may have disconnected this one
+                    client = key.data
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(client)
+                    if events & selectors.EVENT_READ and not client.closed:
+                        self.on_readable(client)
+            if time.monotonic() >= next_sweep:
+                for client in [key.data for key in self.selector.get_map().values() if key.data]:
+                    if not self.check_idle(client):
+                        self.disconnect(client)
+                next_sweep = time.monotonic() + sweep_s
+
+    def accept_all(self, listener):
         while True:
             try:
-                cmd, *params = client_sock.recv(4096).decode().split(",", 1)
-            except Exception as e:
-                print(f"Something went wrong handling client: {e}")
-                raise
+                client_sock, addr = listener.accept()
+            except BlockingIOError:
+                return
+            client_sock.setblocking(False)
+            client = Client(client_sock)
+            with self.lock:
+                self.conn_stats.opened += 1
+            self.selector.register(client_sock, selectors.EVENT_READ, client)
 
-            if cmd == "register":
-                [user] = params
-                with self.lock:
-                    self.clients[user] = client_sock
-                print(f"{user} has joined the chat")
-                client_sock.send("ack".encode())
-            elif cmd == "list":
-                with self.lock:
-                    names = self.clients.keys()
-                client_sock.send((", ".join(names) + "\n").encode())
-            elif cmd == "tell":
-                recipient, msg = params[0].split(",", 1)
+    def on_readable(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.disconnect(client)
+            return
+        try:
+            self.feed(client, data)
+        except FrameError as e:
+            print(f"{client.user} sent a bad frame ({e}); disconnecting")
+            self.disconnect(client)
+
+    def drain_handoffs(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.handoffs:
+            client, data = self.handoffs.popleft()
+            self.send(client, data)
+
+    def write_outbox(self, client):
+        sock = client.sock
+        log = self.message_log
+        while True:
+            batch = client.outbox.dequeue_many(256)
+            if None in batch:
+                break
+            if client.broken:
+                if log is not None:
+                    log.requeue(batch)
+                continue
+            try:
+                # sendall, so a frame is never cut short by a partial send
+                sock.sendall(b"".join(batch))
+            except OSError:
+                # Wake the reader so it disconnects; keep draining so senders
+                # don't block on the outbox until its None arrives
+                client.broken = True
+                if log is not None:
+                    log.requeue(batch)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            else:
+                if log is not None:
+                    log.delivered(batch)
+        # Anyone who raced disconnect past the closed check finds room and
+        # returns at once, instead of waiting out send_timeout_s
+        while batch:
+            if log is not None:
+                log.requeue(batch)
+            batch = client.outbox.dequeue_many(256, timeout=0)
+        # The reader is done with the socket by the time it sends None, so
+        # closing here can't pull the fd out from under either thread
+        sock.close()
+
+    def send(self, client, data):
+        if self.selector is None:
+            if client.closed:
+                return
+            try:
+                client.outbox.enqueue(data, self.send_timeout_s)
+            except Full:
+                if self.verbose:
+                    print(f"{client.user} isn't keeping up; disconnecting")
+                # Its reader thread sees the shutdown and cleans up
+                try:
+                    client.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            return
+        if get_ident() != self.loop_thread:
+            self.handoffs.append((client, data))
+            try:
+                self.wake_w.send(b"\0")
+            except BlockingIOError:
+                # The loop has wakeups pending already
+                pass
+            return
+        if client.closed:
+            return
+        if client.outbuf:
+            client.outbuf += data
+            if len(client.outbuf) > self.max_outbuf:
+                if self.verbose:
+                    print(f"{client.user} isn't keeping up; disconnecting")
+                self.disconnect(client)
+            return
+        try:
+            sent = client.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(client)
+            return
+        if sent < len(data):
+            client.outbuf += data[sent:]
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.outbuf)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.disconnect(client)
+            return
+        del client.outbuf[:sent]
+        client.drained += sent
+        while client.in_flight and client.in_flight[0][0] <= client.drained:
+            self.message_log.delivered((client.in_flight.popleft()[1],))
+        if client.backlog is not None:
+            self.pump_backlog(client)
+        if not client.outbuf and not client.closed:
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def pump_backlog(self, client):
+        # Tops the buffer up from the log as it drains, instead of mapping the
+        # whole backlog into memory at once
+        while not client.closed and len(client.outbuf) < self.max_outbuf // 2:
+            chunk = next(client.backlog, None)
+            if chunk is None:
+                client.backlog = None
+                return
+            self.send(client, chunk)
+            if client.closed:
+                # Too late for disconnect() to have handed it back
+                self.message_log.requeue((chunk,))
+            elif client.outbuf:
+                client.in_flight.append((client.drained + len(client.outbuf), chunk))
+            else:
+                self.message_log.delivered((chunk,))
+
+    def disconnect(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        if client.backlog is not None:
+            # Hands whatever's left back to the log
+            client.backlog.close()
+        if client.in_flight:
+            self.message_log.requeue(chunk for _, chunk in client.in_flight)
+        with self.lock:
+            if client.user_id:
+                self.users.remove(client.user, client.user_id, client)
+            if self.clients.get(client.user) is client:
+                clients = dict(self.clients)
+                del clients[client.user]
+                self.clients = clients
+            self.conn_stats.closed += 1
+        if self.selector is not None:
+            self.selector.unregister(client.sock)
+            client.sock.close()
+            return
+        # Wakes the writer if it's stuck in sendall; it closes the socket on its way out
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            client.outbox.enqueue(None, self.send_timeout_s)
+        except Full:
+            # The writer has stopped draining, so it won't be closing the socket either
+            client.sock.close()
+
+    def register(self, client, user):
+        with self.lock:
+            if client.user_id:
+                # Registering again under a new name lets go of the old one
+                self.users.remove(client.user, client.user_id, client)
+                if self.clients.get(client.user) is client:
+                    clients = dict(self.clients)
+                    del clients[client.user]
+                    self.clients = clients
+            client.user = user
+            client.user_id = self.users.add(user, client)
+            clients = dict(self.clients)
+            clients[user] = client
+            self.clients = clients
+            backlog = None
+            if self.message_log is not None:
+                # Taken with the client published, so a tell that missed it in
+                # clients has already appended by now, and any later one finds it
+                backlog = self.message_log.replay(user, client.binary)
+        if self.verbose:
+            print(f"{user} has joined the chat")
+        self.send(client, pack(OP_ACK, client.user_id) if client.binary else frame("ack"))
+        if backlog is None:
+            return
+        if self.selector is not None:
+            client.backlog = backlog
+            self.pump_backlog(client)
+            return
+        for chunk in backlog:
+            # Blocks for as long as the writer takes: it's this client's own thread
+            client.outbox.enqueue(chunk)
+            if client.broken:
+                backlog.close()
+
+    def deliver(self, client, recp, body):
+        try:
+            self.send(recp, tell_frame(recp.binary, client.user, client.user_id, body))
+        except OSError:
+            # Shutting down a slow recipient that's already gone; its own thread cleans up
+            pass
+
+    def handle_binary(self, op, user_id, payload, client):
+        if op == OP_TELL:
+            recp = self.users.get(user_id)
+            if recp is None:
+                self.send(client, pack(OP_UNKNOWN, user_id))
+            else:
+                self.deliver(client, recp, payload)
+        elif op == OP_REGISTER:
+            self.register(client, payload.decode())
+        elif op == OP_LOOKUP:
+            self.send(client, lookup_reply(self.clients.get(payload.decode()), payload))
+
+    def handle_msg(self, msg, client):
+        cmd, *params = msg.split(",", 1)
+
+        if cmd == "register":
+            [user] = params
+            self.register(client, user)
+        elif cmd == "list":
+            self.send(client, frame(", ".join(self.clients)))
+        elif cmd == "stats":
+            self.send(client, frame(self.conn_stats.report(len(self.clients))))
+        elif cmd == "tell":
+            recipient, msg = params[0].split(",", 1)
+            recp = self.clients.get(recipient)
+            if recp is None and self.message_log is not None:
                 with self.lock:
-                    recp_sock = self.clients.get(recipient)
-                if recp_sock is None:
-                    client_sock.send(f"Unkown user: {recipient}".encode())
-                else:
-                    recp_sock.send(f"{user}: {msg}".encode())
+                    # Checked again under register()'s lock, so the recipient
+                    # can't take its backlog between this check and the append
+                    recp = self.clients.get(recipient)
+                    if recp is None:
+                        self.message_log.append(recipient, client.user, msg)
+                        return
+            if recp is not None:
+                self.deliver(client, recp, msg)
+            else:
+                self.send(client, frame(f"Unkown user: {recipient}"))
 
 
 class User:
@@ -66,28 +496,45 @@ class User:
 
     def recv_msg(self, srv_sock):
         while True:
-            print(f"{self.name} received: {srv_sock.recv(4096).decode()}")
+            try:
+                msg = self.recv_frame(srv_sock)
+            except ConnectionError:
+                print(f"{self.name} was disconnected")
+                return
+            if msg == "ping":
+                srv_sock.send(PONG)
+                continue
+            print(f"{self.name} received: {msg}")
+
+    def recv_frame(self, srv_sock):
+        while not self.pending:
+            if not (data := srv_sock.recv(65536)):
+                raise ConnectionError("server closed the connection")
+            self.pending.extend(self.parser.feed(data))
+        return self.pending.popleft()
 
     # Dummy client that just sends a few canned commands
     def run_client(self):
         srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         srv_sock.connect((self.srv_host, self.srv_port))
+        self.parser = FrameParser()
+        self.pending = deque()
 
-        srv_sock.send(f"register,{self.name}".encode())
+        srv_sock.send(frame(f"register,{self.name}"))
         print(f"{self.name} is registering")
-        srv_sock.recv(4096).decode()
+        self.recv_frame(srv_sock)
 
         time.sleep(3)
 
-        srv_sock.send("list,all".encode())
-        users = srv_sock.recv(4096).decode().split(", ")
+        srv_sock.send(frame("list,all"))
+        users = self.recv_frame(srv_sock).split(", ")
 
         Thread(target=self.recv_msg, args=(srv_sock,), daemon=True).start()
 
         while True:
             recp = random.choice(users)
             msg = random.choice(self.THINGS_TO_SAY)
-            srv_sock.send(f"tell,{recp},{msg}".encode())
+            srv_sock.send(frame(f"tell,{recp},{msg}"))
             time.sleep(random.randint(3, 7))
 
 
@@ -115,5 +562,90 @@ def main(run_for_s):
     time.sleep(run_for_s)
 
 
+def connect_registered(name, srv_port):
+    sock = socket.create_connection(("127.0.0.1", srv_port))
+    parser = FrameParser()
+    sock.sendall(frame(f"register,{name}"))
+    while not parser.feed(data := sock.recv(4096)):
+        if not data:
+            raise ConnectionError(f"server closed {name}'s connection")
+    return sock, parser
+
+
+def check_interleaving(engine, n_senders, n_msgs, body_size):
+    """Has n_senders tell one recipient n_msgs bodies each, concurrently.
+
+    Every body is one character repeated, specific to its sender, after a
+    sequence number, so a frame that was cut short or spliced into another
+    shows up as a bad body or a gap in that sender's sequence.
+    """
+    srv_port = random.randint(10000, 55555)
+    # Room for the whole burst: one thread can't push back on 200 senders the
+    # way a bounded outbox per client does, and the point here is what arrives
+    srv = ChatServerThreaded(
+        srv_port,
+        verbose=False,
+        engine=engine,
+        backlog=n_senders,
+        max_outbuf=n_senders * n_msgs * (body_size + 64),
+    )
+    Thread(target=srv.run_server, daemon=True).start()
+    while True:
+        try:
+            sink, parser = connect_registered("sink", srv_port)
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    senders = [connect_registered(f"s{i}", srv_port)[0] for i in range(n_senders)]
+
+    def chatter(i, sock):
+        fill = chr(ord("a") + i % 26) * body_size
+        for seq in range(n_msgs):
+            sock.sendall(frame(f"tell,sink,{seq} {fill}"))
+
+    expected = [0] * n_senders
+    received = bad = 0
+    threads = [Thread(target=chatter, args=(i, sock)) for i, sock in enumerate(senders)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    sink.settimeout(5)
+    try:
+        while received < n_senders * n_msgs and (data := sink.recv(65536)):
+            for msg in parser.feed(data):
+                received += 1
+                sender, _, body = msg.partition(": ")
+                seq, _, fill = body.partition(" ")
+                try:
+                    i = int(sender[1:])
+                    ok = int(seq) == expected[i] and fill == chr(ord("a") + i % 26) * body_size
+                except (ValueError, IndexError):
+                    ok = False
+                if ok:
+                    expected[i] += 1
+                else:
+                    bad += 1
+    except socket.timeout:
+        pass
+    elapsed = time.perf_counter() - start
+    for sock in senders + [sink]:
+        sock.close()
+    return received / elapsed, received, bad
+
+
+def bench(n_senders=200):
+    # Big bodies are what used to come out of a single send() only partly written
+    for n_msgs, body_size in ((100, 4096), (20, 65536)):
+        for engine in Engine:
+            rate, received, bad = check_interleaving(engine, n_senders, n_msgs, body_size)
+            print(
+                f"{engine.value:<9} {n_senders} senders -> 1 recipient, {body_size:>5}B bodies: {rate:>8,.0f} msgs/s "
+                f"received={received}/{n_senders * n_msgs} corrupt or out of order={bad}"
+            )
+
+
 if __name__ == "__main__":
-    main(int(sys.argv[1]))
+    if sys.argv[1:] == ["bench"]:
+        bench()
+    else:
+        main(int(sys.argv[1]))
@@ -1,33 +1,311 @@
+import fcntl
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
 import time
-from threading import Condition, Thread
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock, Thread
+
+
+class Waiter:
+    def __init__(self, n):
+        self.n = n
+        self.granted = False
+        # Held until a release hands this waiter its permits
+        self.lock = Lock()
+        self.lock.acquire()
 
 
 class CountSemaphore:
+    """Weighted counting semaphore that hands out permits strictly first come, first served.
+
+    Each waiter blocks on its own lock, so a release wakes only the waiters at
+    the head of the queue that it can now satisfy, rather than all of them.
+    Permits are granted before the waiter wakes, so nobody can barge in ahead
+    of it, and a large request at the head holds back smaller ones behind it
+    instead of being starved by them.
+    """
+
     def __init__(self, max_count):
         self.max_count = max_count
         self.given_out = 0
-        self.cv = Condition()
+        self.lock = Lock()
+        self.waiters = deque()
+
+    def acquire(self, n=1, timeout=None):
+        if n > self.max_count:
+            raise ValueError(f"can't acquire {n} permits from a semaphore of {self.max_count}")
+        with self.lock:
+            if not self.waiters and self.given_out + n <= self.max_count:
+                self.given_out += n
+                return True
+            if timeout is not None and timeout <= 0:
+                return False
+            waiter = Waiter(n)
+            self.waiters.append(waiter)
+
+        if waiter.lock.acquire(timeout=-1 if timeout is None else timeout):
+            return True
+        with self.lock:
+            # A release may have granted the permits just as the wait timed out
+            if waiter.granted:
+                return True
+            self.waiters.remove(waiter)
+            # It may have been the head, holding back waiters that fit now
+            self.grant()
+        return False
+
+    def try_acquire(self, n=1):
+        return self.acquire(n, timeout=0)
+
+    def release(self, n=1):
+        with self.lock:
+            if n > self.given_out:
+                raise ValueError(f"can't release {n} permits, only {self.given_out} are held")
+            self.given_out -= n
+            self.grant()
+
+    def grant(self):
+        # Assumes the lock is held
+        while self.waiters and self.given_out + self.waiters[0].n <= self.max_count:
+            waiter = self.waiters.popleft()
+            self.given_out += waiter.n
+            waiter.granted = True
+            waiter.lock.release()
+
+    @contextmanager
+    def held(self, n=1):
+        self.acquire(n)
+        try:
+            yield self
+        finally:
+            self.release(n)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# Shared memory layout, in 8-byte fields: the header, then a (pid, permits held)
+# row per process holding permits, then a ring of (pid, permits wanted) rows,
+# one per waiting ticket; a waiter that gave up zeroes its permits wanted.
+GIVEN_OUT, HEAD, TAIL = range(3)
+HEADER_FIELDS = 3
+HOLDER_FIELDS = 2
+WAITER_FIELDS = 2
+
+# Taken by whichever thread of a new process reopens a semaphore's lock first.
+# Replaced in each forked child, in case a parent thread held it at the fork.
+reopen_lock = Lock()
 
-    def release(self):
+
+def reset_reopen_lock():
+    global reopen_lock
+    reopen_lock = Lock()
+
+
+os.register_at_fork(after_in_child=reset_reopen_lock)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
         pass
+    return True
+
+
+class SharedMemoryCountSemaphore(CountSemaphore):
+    """CountSemaphore whose permits and FIFO wait queue live in shared memory, for use across processes.
+
+    The lock is a threading.Lock for threads within a process plus an flock on
+    a file between processes, which the kernel drops if its holder dies.
+    Permits are accounted per process, so a process must release what it
+    acquired; permits held, and places queued, by a process that has died are
+    reclaimed by whoever is waiting behind them. With no cross-process
+    Condition to park on, waiters spin briefly then back off, like
+    SharedMemoryBarrier, but unlike it this can be pickled to any process.
+    """
+
+    SPINS_BEFORE_SLEEP = 100
+    SLEEP_S = 0.0001
+    REAP_EVERY_S = 0.05
+
+    def __init__(self, max_count, max_processes=64, max_waiters=1024):
+        self.max_count = max_count
+        self.max_processes = max_processes
+        self.max_waiters = max_waiters
+        fd, self.lock_path = tempfile.mkstemp(prefix="count-semaphore-")
+        os.close(fd)
+        size = 8 * (HEADER_FIELDS + HOLDER_FIELDS * max_processes + WAITER_FIELDS * max_waiters)
+        self.shm = SharedMemory(create=True, size=size)
+        self.shm.buf[:size] = bytes(size)
+        self.attach()
+
+    def attach(self):
+        self.fields = self.shm.buf.cast("q")
+        self.open_lock()
+
+    def open_lock(self):
+        # Each process needs its own open file: a forked child shares its
+        # parent's, and with it whatever flock the parent holds
+        self.lock_file = open(self.lock_path, "rb")
+        self.thread_lock = Lock()
+        self.holder_row = None
+        # Last, so no other thread sees the new pid alongside the old lock
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        return {
+            "max_count": self.max_count,
+            "max_processes": self.max_processes,
+            "max_waiters": self.max_waiters,
+            "lock_path": self.lock_path,
+            "shm": self.shm,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
 
-    def acquire(self):
-        self.cv.acquire()
-        while self.given_out >= self.max_count:
-            self.cv.wait()
+    @contextmanager
+    def locked(self):
+        if self.pid != os.getpid():
+            with reopen_lock:
+                if self.pid != os.getpid():
+                    self.open_lock()
+        with self.thread_lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield self.fields
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
 
-        self.given_out += 1
-        self.cv.notify_all()
-        self.cv.release()
+    def acquire(self, n=1, timeout=None):
+        if n > self.max_count:
+            raise ValueError(f"can't acquire {n} permits from a semaphore of {self.max_count}")
+        with self.locked() as fields:
+            if fields[HEAD] == fields[TAIL] and fields[GIVEN_OUT] + n <= self.max_count:
+                self.take(n)
+                return True
+            if timeout is not None and timeout <= 0:
+                return False
+            if fields[TAIL] - fields[HEAD] >= self.max_waiters:
+                raise RuntimeError(f"more than {self.max_waiters} waiters queued")
+            ticket = fields[TAIL]
+            fields[TAIL] += 1
+            row = self.waiter_row(ticket)
+            fields[row] = self.pid
+            fields[row + 1] = n
 
-    def release(self):
-        self.cv.acquire()
-        while self.given_out == 0:
-            self.cv.wait()
+        fields = self.fields
+        deadline = None if timeout is None else time.monotonic() + timeout
+        next_reap = time.monotonic() + self.REAP_EVERY_S
+        spins = 0
+        while True:
+            now = time.monotonic()
+            # Peek without the lock; it's only taken when there's something to do
+            if (
+                fields[HEAD] == ticket
+                and fields[GIVEN_OUT] + n <= self.max_count
+                or now >= next_reap
+                or deadline is not None
+                and now >= deadline
+            ):
+                with self.locked():
+                    if now >= next_reap:
+                        self.reap()
+                        next_reap = now + self.REAP_EVERY_S
+                    if fields[HEAD] == ticket and fields[GIVEN_OUT] + n <= self.max_count:
+                        fields[HEAD] += 1
+                        self.skip_abandoned()
+                        self.take(n)
+                        return True
+                    if deadline is not None and now >= deadline:
+                        fields[row + 1] = 0
+                        self.skip_abandoned()
+                        return False
+            spins += 1
+            time.sleep(0 if spins < self.SPINS_BEFORE_SLEEP else self.SLEEP_S)
 
-        self.given_out -= 1
-        self.cv.notify_all()
-        self.cv.release()
+    def release(self, n=1):
+        with self.locked() as fields:
+            row = self.find_holder_row()
+            if row is None:
+                raise ValueError(f"can't release {n} permits, this process holds none")
+            held = fields[row + 1]
+            if n > held:
+                raise ValueError(f"can't release {n} permits, this process only holds {held}")
+            fields[row + 1] -= n
+            fields[GIVEN_OUT] -= n
+            if fields[row + 1] == 0:
+                fields[row] = 0
+
+    # The rest assume the lock is held
+    def waiter_row(self, ticket):
+        return HEADER_FIELDS + HOLDER_FIELDS * self.max_processes + WAITER_FIELDS * (
+            ticket % self.max_waiters
+        )
+
+    def find_holder_row(self, claim=False):
+        fields = self.fields
+        if self.holder_row is not None and fields[self.holder_row] == self.pid:
+            return self.holder_row
+        free = None
+        for row in range(HEADER_FIELDS, HEADER_FIELDS + HOLDER_FIELDS * self.max_processes, HOLDER_FIELDS):
+            if fields[row] == self.pid:
+                self.holder_row = row
+                return row
+            if fields[row] == 0 and free is None:
+                free = row
+        if not claim:
+            return None
+        if free is None:
+            raise RuntimeError(f"more than {self.max_processes} processes holding permits")
+        fields[free] = self.pid
+        fields[free + 1] = 0
+        self.holder_row = free
+        return free
+
+    def take(self, n):
+        row = self.find_holder_row(claim=True)
+        self.fields[row + 1] += n
+        self.fields[GIVEN_OUT] += n
+
+    def skip_abandoned(self):
+        fields = self.fields
+        while fields[HEAD] < fields[TAIL] and fields[self.waiter_row(fields[HEAD]) + 1] == 0:
+            fields[HEAD] += 1
+
+    def reap(self):
+        fields = self.fields
+        for row in range(HEADER_FIELDS, HEADER_FIELDS + HOLDER_FIELDS * self.max_processes, HOLDER_FIELDS):
+            if fields[row] and not process_alive(fields[row]):
+                fields[GIVEN_OUT] -= fields[row + 1]
+                fields[row] = fields[row + 1] = 0
+        for ticket in range(fields[HEAD], fields[TAIL]):
+            row = self.waiter_row(ticket)
+            if fields[row + 1] and not process_alive(fields[row]):
+                fields[row + 1] = 0
+        self.skip_abandoned()
+
+    def close(self):
+        self.fields.release()
+        self.shm.close()
+        self.lock_file.close()
+
+    def unlink(self):
+        self.shm.unlink()
+        os.unlink(self.lock_path)
 
 
 def ping(sem):
@@ -69,5 +347,147 @@ def main():
     pong_t.join()
 
 
+def jain_index(values):
+    """1.0 when every value is equal, down to 1/len(values) when one has it all."""
+    total = sum(values)
+    squares = sum(value * value for value in values)
+    return total * total / (len(values) * squares) if squares else 1.0
+
+
+def contend(sem, n_threads, duration_s, hold_s, weights=(1,)):
+    """Each thread repeatedly takes a permit, holds it for hold_s, and gives it back.
+
+    Returns acquisitions per second, each thread's acquisition count, and every wait.
+    """
+    counts = [0] * n_threads
+    waits = [[] for _ in range(n_threads)]
+    deadline = time.perf_counter() + duration_s
+
+    def worker(i):
+        n = weights[i % len(weights)]
+        wait_times = waits[i]
+        while (start := time.perf_counter()) < deadline:
+            sem.acquire(n)
+            wait_times.append(time.perf_counter() - start)
+            time.sleep(hold_s)
+            sem.release(n)
+            counts[i] += 1
+
+    threads = [Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return sum(counts) / elapsed, counts, [w for thread_waits in waits for w in thread_waits]
+
+
+class StdlibSemaphore:
+    # threading.Semaphore behind the acquire(n)/release(n) used above; n is always 1
+    def __init__(self, max_count):
+        self.sem = threading.Semaphore(max_count)
+
+    def acquire(self, n=1):
+        return self.sem.acquire()
+
+    def release(self, n=1):
+        self.sem.release()
+
+
+def bench(permits=4, duration_s=2):
+    for n_threads in (8, 32, 128):
+        for hold_s in (0, 0.001):
+            for name, sem in (
+                ("threading.Semaphore", StdlibSemaphore(permits)),
+                ("CountSemaphore", CountSemaphore(permits)),
+            ):
+                rate, counts, waits = contend(sem, n_threads, duration_s, hold_s)
+                waits.sort()
+                print(
+                    f"{name:<19} threads={n_threads:<3} hold={hold_s * 1000:.0f}ms {rate:>9,.0f} acquires/s "
+                    f"jain={jain_index(counts):.3f} min/max per thread={min(counts)}/{max(counts)} "
+                    f"p99 wait={waits[int(len(waits) * 0.99)] * 1000:7.2f}ms max wait={waits[-1] * 1000:7.2f}ms"
+                )
+    # Mixed weights: a thread wanting every permit at once still gets its turn
+    weights = (1, 1, 1, permits)
+    rate, counts, waits = contend(CountSemaphore(permits), 16, duration_s, 0.001, weights)
+    heavy = counts[len(weights) - 1 :: len(weights)]
+    print(
+        f"CountSemaphore      weights 1,1,1,{permits}: {rate:>9,.0f} acquires/s "
+        f"heavy threads got {sum(heavy)} of {sum(counts)}"
+    )
+
+
+def round_trips(sem, n_round_trips, start_barrier, results):
+    # Line everyone up first so process start-up isn't counted
+    start_barrier.wait()
+    start = time.perf_counter()
+    for _ in range(n_round_trips):
+        sem.acquire()
+        sem.release()
+    results.put(time.perf_counter() - start)
+
+
+def process_round_trips_per_second(sem, n_procs, n_round_trips):
+    start_barrier = multiprocessing.Barrier(n_procs)
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(
+            target=round_trips, args=(sem, n_round_trips, start_barrier, results)
+        )
+        for _ in range(n_procs)
+    ]
+    for proc in procs:
+        proc.start()
+    elapsed = max(results.get() for _ in procs)
+    for proc in procs:
+        proc.join()
+    return n_procs * n_round_trips / elapsed
+
+
+def crash_holding(sem, n, acquired):
+    sem.acquire(n)
+    acquired.set()
+    os._exit(1)
+
+
+def bench_processes(permits=4, n_round_trips=1000):
+    print(f"{os.cpu_count()} cores available")
+    with multiprocessing.Manager() as manager:
+        for n_procs in (2, 4, 8, 16, 32):
+            shm_sem = SharedMemoryCountSemaphore(permits)
+            shm = process_round_trips_per_second(shm_sem, n_procs, n_round_trips)
+            shm_sem.close()
+            shm_sem.unlink()
+            managed = process_round_trips_per_second(
+                manager.Semaphore(permits), n_procs, n_round_trips
+            )
+            print(
+                f"processes={n_procs:<3} SharedMemoryCountSemaphore={shm:>9,.0f} "
+                f"Manager().Semaphore={managed:>9,.0f} round trips/s"
+            )
+
+    sem = SharedMemoryCountSemaphore(permits)
+    acquired = multiprocessing.Event()
+    proc = multiprocessing.Process(target=crash_holding, args=(sem, permits, acquired))
+    proc.start()
+    acquired.wait()
+    proc.join()
+    start = time.perf_counter()
+    reclaimed = sem.acquire(permits, timeout=5)
+    print(
+        f"a process died holding all {permits} permits: reclaimed={reclaimed} "
+        f"after {(time.perf_counter() - start) * 1000:.0f}ms"
+    )
+    sem.release(permits)
+    sem.close()
+    sem.unlink()
+
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["bench"]:
+        bench()
+        bench_processes()
+    else:
+        main()
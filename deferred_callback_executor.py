@@ -1,59 +1,552 @@
+import gc
 import heapq
 import math
+import multiprocessing
 import random
+import sys
 import time
-from threading import Condition, Thread, current_thread
+import tracemalloc
+from collections import deque
+from enum import Enum
+from itertools import count
+from threading import Condition, Lock, Thread, current_thread
 
+from async_to_sync import WorkerPool
+
+
+class Backend(Enum):
+    HEAP = "heap"
+    WHEEL = "wheel"
+
+
+class Recurrence(Enum):
+    # Runs every period_ms measured from when each run was due, skipping any
+    # that are missed altogether
+    FIXED_RATE = "fixed-rate"
+    # Runs period_ms after each run finishes
+    FIXED_DELAY = "fixed-delay"
+
+
+# Heaps smaller than this are left to shed their tombstones as they're popped
+COMPACT_MIN = 1024
+
+
+class HeapTimers:
+    """Pending actions in a binary heap: O(log n) insert, O(1) cancel by tombstoning the entry.
+
+    Tombstones are dropped as they reach the top, and once they make up more
+    than compact_fraction of the heap it's rebuilt without them.
+    """
+
+    def __init__(self, compact_fraction=0.5):
+        self.heap = []
+        self.live = 0
+        self.dead = 0
+        self.compact_fraction = compact_fraction
+        self.compactions = 0
+        # Breaks ties so entries never fall back to comparing actions
+        self.seq = count()
+
+    def __len__(self):
+        return self.live
+
+    def __contains__(self, action):
+        return action.entry is not None
+
+    def push(self, action):
+        action.entry = [action.exec_at, next(self.seq), action]
+        heapq.heappush(self.heap, action.entry)
+        self.live += 1
+
+    def cancel(self, action):
+        if action.entry is None:
+            return False
+        action.entry[2] = None
+        action.entry = None
+        self.live -= 1
+        self.dead += 1
+        if (
+            self.compact_fraction is not None
+            and len(self.heap) >= COMPACT_MIN
+            and self.dead > self.compact_fraction * len(self.heap)
+        ):
+            self.compact()
+        return True
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if entry[2] is not None]
+        heapq.heapify(self.heap)
+        self.dead = 0
+        self.compactions += 1
+
+    def next_deadline(self):
+        heap = self.heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self.dead -= 1
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now):
+        heap = self.heap
+        due = []
+        while heap and heap[0][0] <= now:
+            action = heapq.heappop(heap)[2]
+            if action is None:
+                self.dead -= 1
+            else:
+                action.entry = None
+                due.append(action)
+        self.live -= len(due)
+        return due
+
+
+# Each wheel level has 2 ** SLOT_BITS slots, and a slot at level L spans
+# 2 ** (SLOT_BITS * L) milliseconds, so four levels reach about 49 days out.
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+MASK = SLOTS - 1
+LEVELS = 4
+WHEEL_SPAN = 1 << (SLOT_BITS * LEVELS)
+
+
+class TimingWheel:
+    """Pending actions in a hierarchical timing wheel with millisecond ticks.
+
+    Each slot is a dict used as an insertion-ordered set, so inserting and
+    cancelling are O(1). An action goes into the lowest level whose span
+    covers its delay; whenever a level's slot comes round, its actions
+    cascade down into finer levels, until they reach level 0 and fire.
+    """
+
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.tick = 0
+        self.live = 0
+        self.levels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+
+    def __len__(self):
+        return self.live
+
+    def __contains__(self, action):
+        return action.bucket is not None
+
+    def ms(self, t):
+        return int((t - self.origin) * 1000)
+
+    def push(self, action):
+        self.place(action, self.tick + 1)
+        self.live += 1
+
+    def place(self, action, earliest):
+        # Round up so nothing fires early, and never into a tick already past
+        expires = int((action.exec_at - self.origin) * 1000) + 1
+        if expires < earliest:
+            expires = earliest
+        delta = expires - self.tick
+        if delta < SLOTS:
+            bucket = self.levels[0][expires & MASK]
+        else:
+            if delta >= WHEEL_SPAN:
+                # Park it in the farthest slot; it's placed again when that cascades
+                delta = WHEEL_SPAN - 1
+                expires = self.tick + delta
+            level = (delta.bit_length() - 1) // SLOT_BITS
+            bucket = self.levels[level][(expires >> (SLOT_BITS * level)) & MASK]
+        bucket[action] = None
+        action.bucket = bucket
+
+    def cancel(self, action):
+        if action.bucket is None:
+            return False
+        del action.bucket[action]
+        action.bucket = None
+        self.live -= 1
+        return True
+
+    def next_tick(self):
+        """The earliest tick at which a slot fires or cascades, or None if the wheel is empty."""
+        if not self.live:
+            return None
+        for level, slots in enumerate(self.levels):
+            shift = SLOT_BITS * level
+            pos = self.tick >> shift
+            end = (pos | MASK) + 1
+            for p in range(pos + 1, end):
+                if slots[p & MASK]:
+                    return p << shift
+            # Anything left at this level is due on its next rotation, which
+            # starts where the level above cascades
+            if any(slots):
+                return end << shift
+        return None
+
+    def cascade(self, tick):
+        # Top down, so whatever a coarse slot drops into a finer slot that's
+        # also due now gets moved on again
+        levels = [
+            level for level in range(1, LEVELS) if tick & ((1 << (SLOT_BITS * level)) - 1) == 0
+        ]
+        for level in reversed(levels):
+            bucket = self.levels[level][(tick >> (SLOT_BITS * level)) & MASK]
+            actions = list(bucket)
+            bucket.clear()
+            for action in actions:
+                self.place(action, tick)
+
+    def next_deadline(self):
+        tick = self.next_tick()
+        return None if tick is None else self.origin + tick / 1000
+
+    def pop_due(self, now):
+        target = self.ms(now)
+        due = []
+        while (tick := self.next_tick()) is not None and tick <= target:
+            self.tick = tick
+            if tick & MASK == 0:
+                self.cascade(tick)
+            bucket = self.levels[0][tick & MASK]
+            due.extend(bucket)
+            bucket.clear()
+        # Nothing fires or cascades in between, so it's safe to jump ahead
+        self.tick = max(self.tick, target)
+        for action in due:
+            action.bucket = None
+        self.live -= len(due)
+        return due
+
+
+class DispatchStats:
+    """How late actions start, and how many are waiting for a worker."""
 
-class DeferredCallbackExecutor:
     def __init__(self):
-        self.actions = []
+        self.lock = Lock()
+        self.dispatched = 0
+        self.started = 0
+        self.max_queue_depth = 0
+        self.total_lateness_s = 0.0
+        self.max_lateness_s = 0.0
+
+    @property
+    def queue_depth(self):
+        return self.dispatched - self.started
+
+    def on_dispatch(self, n):
+        with self.lock:
+            self.dispatched += n
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def on_start(self, lateness_s):
+        with self.lock:
+            self.started += 1
+            self.total_lateness_s += lateness_s
+            self.max_lateness_s = max(self.max_lateness_s, lateness_s)
+
+    def report(self):
+        mean_ms = self.total_lateness_s / self.started * 1000 if self.started else 0
+        return (
+            f"started={self.started} queue_depth={self.queue_depth} "
+            f"max_queue_depth={self.max_queue_depth} mean_lateness={mean_ms:.2f}ms "
+            f"max_lateness={self.max_lateness_s * 1000:.2f}ms"
+        )
+
+
+class DeferredCallbackExecutor:
+    """Runs each action once its delay is up.
+
+    The timer thread takes every due action in one hold of the lock and hands
+    them to a pool of n_workers threads (or any pool with submit(fn, *args)),
+    so a slow callback never holds up add_action or the next timer. With
+    n_workers=0 callbacks run on the timer thread itself, one after another.
+
+    add_action returns the action itself as a handle to cancel or reschedule
+    it. A recurring action is re-armed once each run finishes, so runs of the
+    same action never overlap, and stays armed until it's cancelled.
+    """
+
+    def __init__(self, backend=Backend.HEAP, n_workers=4, pool=None, compact_fraction=0.5):
+        if backend is Backend.WHEEL:
+            self.timers = TimingWheel()
+        else:
+            self.timers = HeapTimers(compact_fraction)
         self.condition = Condition()
-        self.sleep_for = 0
+        self.stats = DispatchStats()
+        if pool is None and n_workers:
+            pool = WorkerPool(n_workers, name="DeferredCallbackWorker")
+        self.pool = pool
 
     def add_action(self, action):
-        action.exec_at = time.time() + action.delay_ms // 1000
+        action.executor = self
+        action.exec_at = time.monotonic() + action.delay_ms / 1000
         self.condition.acquire()
-        heapq.heappush(self.actions, action)
+        # Adding a pending action again reschedules it
+        self.timers.cancel(action)
+        action.active = True
+        self.timers.push(action)
         self.condition.notify()
         self.condition.release()
+        return action
+
+    def cancel(self, action):
+        """Stops a pending action from firing; returns False if it already fired or was cancelled."""
+        with self.condition:
+            action.active = False
+            return self.timers.cancel(action)
+
+    def reschedule(self, action, delay_ms):
+        action.delay_ms = delay_ms
+        self.add_action(action)
 
     def start(self):
         while True:
             self.condition.acquire()
-            while not self.actions:
-                self.condition.wait()
-            while self.actions:
-                next_action = self.actions[0]
-                sleep_time = next_action.exec_at - time.time()
-                if sleep_time <= 0:
+            while True:
+                deadline = self.timers.next_deadline()
+                now = time.monotonic()
+                if deadline is not None and deadline <= now:
                     break
-                self.condition.wait(timeout=sleep_time)
-            action = heapq.heappop(self.actions)
-            action.action(action)
+                self.condition.wait(timeout=None if deadline is None else deadline - now)
+            due = self.timers.pop_due(now)
+            for action in due:
+                if action.period_ms is None:
+                    action.active = False
             self.condition.release()
 
+            self.stats.on_dispatch(len(due))
+            if self.pool is None:
+                for action in due:
+                    self.run_action(action)
+            else:
+                for action in due:
+                    self.pool.submit(self.run_action, action)
+
+    def run_action(self, action):
+        self.stats.on_start(time.monotonic() - action.exec_at)
+        try:
+            action.action(action)
+        except Exception as e:
+            # Caught here so it can't take a pool worker, or the timer thread, down with it
+            print(f"action {action.name} raised {e!r}")
+        finally:
+            if action.period_ms is not None:
+                self.rearm(action)
+
+    def rearm(self, action):
+        period_s = action.period_ms / 1000
+        with self.condition:
+            # Leave it be if it was cancelled or rescheduled while it ran
+            if not action.active or action in self.timers:
+                return
+            now = time.monotonic()
+            if action.recurrence is Recurrence.FIXED_RATE:
+                missed = (now - action.exec_at) // period_s
+                action.exec_at += (missed + 1) * period_s
+            else:
+                action.exec_at = now + period_s
+            self.timers.push(action)
+            self.condition.notify()
+
 
 class DeferredAction:
-    def __init__(self, action, name, delay_ms):
+    def __init__(self, action, name, delay_ms, period_ms=None, recurrence=Recurrence.FIXED_RATE):
         self.action = action
         self.name = name
         self.delay_ms = delay_ms
+        self.period_ms = period_ms
+        self.recurrence = recurrence
         # Set when action is added to the executor
+        self.executor = None
         self.exec_at = None
+        self.active = False
+        # Where the executor's backend is holding it while pending
+        self.entry = None
+        self.bucket = None
 
     def __lt__(self, other):
         return self.exec_at < other.exec_at
 
+    def cancel(self):
+        if self.executor is None:
+            return False
+        return self.executor.cancel(self)
+
+    def reschedule(self, delay_ms):
+        if self.executor is None:
+            raise RuntimeError(f"action {self.name} hasn't been added to an executor")
+        self.executor.reschedule(self, delay_ms)
+
 
 def shout_fruit(action):
     fruit = random.choice(["🍉", "🍒", "🥭", "🍎", "🍏"])
-    delta = time.time() - action.exec_at
+    delta = time.monotonic() - action.exec_at
     print(
         f"{fruit}! I'm action {action.name}. Time delta between actual and expected execution: {delta}"
     )
 
 
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def noop(action):
+    pass
+
+
+def bench_backend(backend, n_timers, n_probes):
+    executor = DeferredCallbackExecutor(backend)
+    # Request timeouts: a few seconds to a couple of minutes out, mostly cancelled
+    actions = [
+        DeferredAction(noop, i, random.randint(5_000, 120_000)) for i in range(n_timers)
+    ]
+    # As timeit does, keep collector pauses out of the timings
+    gc.collect()
+    gc.disable()
+    start = time.perf_counter()
+    for action in actions:
+        executor.add_action(action)
+    insert_s = time.perf_counter() - start
+    gc.enable()
+
+    # Probe timers fire while the million others stay pending
+    lateness = []
+    executor.add_action(DeferredAction(noop, "warm-up", 0))
+    Thread(target=executor.start, daemon=True).start()
+    for i in range(n_probes):
+        executor.add_action(
+            DeferredAction(
+                lambda action: lateness.append(time.monotonic() - action.exec_at),
+                f"probe-{i}",
+                random.randint(1, 2000),
+            )
+        )
+    while len(lateness) < n_probes:
+        time.sleep(0.1)
+    lateness.sort()
+
+    gc.disable()
+    start = time.perf_counter()
+    for action in actions:
+        executor.cancel(action)
+    cancel_s = time.perf_counter() - start
+    gc.enable()
+
+    # Memory is measured last, on a separate executor, as tracing slows everything down
+    traced = DeferredCallbackExecutor(backend)
+    traced_actions = [DeferredAction(noop, i, action.delay_ms) for i, action in enumerate(actions)]
+    gc.collect()
+    tracemalloc.start()
+    for action in traced_actions:
+        traced.add_action(action)
+    bytes_per_timer = tracemalloc.get_traced_memory()[0] / n_timers
+    tracemalloc.stop()
+
+    print(
+        f"{backend.value:<5} {n_timers:,} timers: insert {n_timers / insert_s:>9,.0f}/s, "
+        f"cancel {n_timers / cancel_s:>9,.0f}/s, {bytes_per_timer:.0f} B/timer, "
+        f"lateness p50={percentile(lateness, 0.5) * 1000:.2f}ms "
+        f"p99={percentile(lateness, 0.99) * 1000:.2f}ms max={lateness[-1] * 1000:.2f}ms"
+    )
+
+
+def bench(n_timers=1_000_000, n_probes=2000):
+    # A process per backend, so neither pays for the other's leftovers
+    for backend in Backend:
+        proc = multiprocessing.Process(target=bench_backend, args=(backend, n_timers, n_probes))
+        proc.start()
+        proc.join()
+
+
+def record_lateness(lateness, work_s):
+    def callback(action):
+        lateness.append(time.monotonic() - action.exec_at)
+        time.sleep(work_s)
+
+    return callback
+
+
+def schedule_load(executor, lateness, rate, duration_s, slow_fraction, batch_s=0.01):
+    per_batch = int(rate * batch_s)
+    fast = record_lateness(lateness, 0.001)
+    slow = record_lateness(lateness, 0.1)
+    next_batch = time.monotonic()
+    for _ in range(int(duration_s / batch_s)):
+        for i in range(per_batch):
+            callback = slow if random.random() < slow_fraction else fast
+            executor.add_action(DeferredAction(callback, i, random.randint(1, 100)))
+        next_batch += batch_s
+        time.sleep(max(0, next_batch - time.monotonic()))
+    return int(duration_s / batch_s) * per_batch
+
+
+def bench_dispatch(rate=10_000, duration_s=2, slow_fraction=0.01):
+    print(
+        f"{rate:,} timers/s for {duration_s}s, {slow_fraction:.0%} of callbacks take 100ms "
+        f"and the rest 1ms"
+    )
+    for n_workers in (0, 8, 32, 128):
+        executor = DeferredCallbackExecutor(n_workers=n_workers)
+        Thread(target=executor.start, daemon=True).start()
+        lateness = []
+        n_timers = schedule_load(executor, lateness, rate, duration_s, slow_fraction)
+        while len(lateness) < n_timers:
+            time.sleep(0.1)
+        p50, p99, p999 = (percentile(sorted(lateness), p) for p in (0.5, 0.99, 0.999))
+        print(
+            f"workers={n_workers:<3} lateness p50={p50 * 1000:>8.2f}ms p99={p99 * 1000:>8.2f}ms "
+            f"p99.9={p999 * 1000:>8.2f}ms  {executor.stats.report()}"
+        )
+
+
+def request_timeouts(executor, n_requests, cancel_fraction, in_flight=1000):
+    # Every request arms a timeout, and all but a few finish in time to cancel it
+    window = deque()
+    for i in range(n_requests):
+        window.append(executor.add_action(DeferredAction(noop, i, 30_000)))
+        if len(window) > in_flight:
+            action = window.popleft()
+            if random.random() < cancel_fraction:
+                action.cancel()
+
+
+def bench_cancel_config(name, backend, compact_fraction, n_requests, cancel_fraction):
+    executor = DeferredCallbackExecutor(backend, n_workers=0, compact_fraction=compact_fraction)
+    gc.collect()
+    gc.disable()
+    start = time.perf_counter()
+    request_timeouts(executor, n_requests, cancel_fraction)
+    elapsed = time.perf_counter() - start
+    gc.enable()
+
+    traced = DeferredCallbackExecutor(backend, n_workers=0, compact_fraction=compact_fraction)
+    gc.collect()
+    tracemalloc.start()
+    request_timeouts(traced, n_requests, cancel_fraction)
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    timers = traced.timers
+    heap = f"heap entries={len(timers.heap):>9,} compactions={timers.compactions:<4}" if backend is Backend.HEAP else ""
+    print(
+        f"{name:<18} {n_requests / elapsed:>9,.0f} requests/s, {len(timers):,} pending, "
+        f"{retained / 2**20:6.1f} MiB retained {heap}"
+    )
+
+
+def bench_cancel(n_requests=1_000_000, cancel_fraction=0.99):
+    print(f"{n_requests:,} request timeouts, {cancel_fraction:.0%} cancelled")
+    configs = [
+        ("heap, no compaction", Backend.HEAP, None),
+        ("heap, compact at 50%", Backend.HEAP, 0.5),
+        ("wheel", Backend.WHEEL, None),
+    ]
+    for name, backend, compact_fraction in configs:
+        proc = multiprocessing.Process(
+            target=bench_cancel_config,
+            args=(name, backend, compact_fraction, n_requests, cancel_fraction),
+        )
+        proc.start()
+        proc.join()
+
+
 def main():
     executor = DeferredCallbackExecutor()
     Thread(target=executor.start, daemon=True).start()
@@ -62,9 +555,19 @@ def main():
         executor.add_action(
             DeferredAction(shout_fruit, f"ShoutFruit-{i}", delay_s * 1000)
         )
+    heartbeat = executor.add_action(
+        DeferredAction(shout_fruit, "Heartbeat", 1000, period_ms=3000)
+    )
 
-    time.sleep(11)
+    time.sleep(8)
+    heartbeat.cancel()
+    time.sleep(3)
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["bench"]:
+        bench()
+        bench_dispatch()
+        bench_cancel()
+    else:
+        main()
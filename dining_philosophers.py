@@ -1,7 +1,13 @@
 import random
+import sys
 import time
 from abc import ABC, abstractmethod
-from threading import Semaphore, Thread, current_thread
+from contextlib import contextmanager
+from enum import Enum
+from itertools import count
+from threading import Condition, Event, Lock, Semaphore, Thread, current_thread, local
+
+from count_semaphore import CountSemaphore, jain_index
 
 
 class DiningPhilosophers(ABC):
@@ -66,6 +72,206 @@ class DiningPhilosophersLeftHanded(DiningPhilosophers):
             sem.release()
 
 
+class LockManager(ABC):
+    """All-or-nothing, deadlock-free locking of arbitrary sets of resources.
+
+        with manager.acquire_all({"alice", "bob"}):
+            transfer("alice", "bob", 100)
+
+    Resource IDs can be any hashable, but must be sortable against each other
+    for the strategies that take them in order. Holding locks from two
+    acquire_all blocks at once in one thread isn't supported.
+    """
+
+    @contextmanager
+    def acquire_all(self, resource_ids):
+        resource_ids = set(resource_ids)
+        self.lock_all(resource_ids)
+        try:
+            yield
+        finally:
+            self.unlock_all(resource_ids)
+
+    @abstractmethod
+    def lock_all(self, resource_ids):
+        pass
+
+    @abstractmethod
+    def unlock_all(self, resource_ids):
+        pass
+
+
+class OrderedLockManager(LockManager):
+    """Takes one lock per resource in sorted order, so no two transactions can wait on each other in a cycle."""
+
+    def __init__(self):
+        self.locks = {}
+
+    def lock_for(self, resource_id):
+        # setdefault is atomic, so racing threads still end up sharing one lock
+        return self.locks.get(resource_id) or self.locks.setdefault(resource_id, Lock())
+
+    def lock_all(self, resource_ids):
+        for resource_id in sorted(resource_ids):
+            self.lock_for(resource_id).acquire()
+
+    def unlock_all(self, resource_ids):
+        for resource_id in resource_ids:
+            self.locks[resource_id].release()
+
+
+class AdmissionLockManager(OrderedLockManager):
+    """DiningPhilosophersEatingSemaphore's extra semaphore in front of OrderedLockManager.
+
+    With five forks round a table, letting only four philosophers reach for
+    them is enough to rule out deadlock; with arbitrary resource sets it no
+    longer is, so locks are still taken in order, and the semaphore only caps
+    how many transactions contend for them at once. The semaphore is a
+    CountSemaphore, whose FIFO queue lets transactions in in arrival order.
+    """
+
+    def __init__(self, max_holders=4):
+        super().__init__()
+        self.admission = CountSemaphore(max_holders)
+
+    def lock_all(self, resource_ids):
+        # Order matters: get the admission semaphore first
+        self.admission.acquire()
+        super().lock_all(resource_ids)
+
+    def unlock_all(self, resource_ids):
+        super().unlock_all(resource_ids)
+        self.admission.release()
+
+
+class Fork:
+    def __init__(self, owner):
+        self.owner = owner
+        self.dirty = False
+        # Diners waiting for it to be handed over
+        self.requests = []
+
+
+class Diner:
+    def __init__(self, lock):
+        self.wakeup = Condition(lock)
+        # Set while hungry or eating; lower tickets have been waiting longer
+        self.ticket = None
+        self.wants = ()
+        self.eating = False
+
+
+class ChandyMisraLockManager(LockManager):
+    """Chandy-Misra resource passing: every resource is a fork some thread owns.
+
+    Forks stay with the last thread to use them, so a thread that keeps
+    coming back to the same resources takes them without any handover. Using
+    a fork makes it dirty; a thread that isn't using a fork hands it over on
+    request if it's dirty or not one it wants, and keeps it if it's clean and
+    wanted. Chandy and Misra settle who keeps a clean fork by a fixed
+    precedence between neighbours; with arbitrary resource sets there are no
+    fixed neighbours, so the thread that's been hungry longest wins instead,
+    and on release a fork goes to the longest-waiting thread that asked for
+    it. Fork state lives under one lock, as the threads share memory anyway.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.forks = {}
+        self.diners = local()
+        self.tickets = count()
+
+    def diner(self):
+        if (diner := getattr(self.diners, "diner", None)) is None:
+            diner = self.diners.diner = Diner(self.lock)
+        return diner
+
+    def lock_all(self, resource_ids):
+        with self.lock:
+            me = self.diner()
+            me.ticket = next(self.tickets)
+            me.wants = resource_ids
+            while not self.request_forks(me):
+                me.wakeup.wait()
+            me.eating = True
+
+    def request_forks(self, me):
+        """Takes every fork me wants that can be had now; returns True if me holds them all."""
+        has_all = True
+        for resource_id in me.wants:
+            fork = self.forks.get(resource_id)
+            if fork is None:
+                self.forks[resource_id] = Fork(me)
+                continue
+            owner = fork.owner
+            if owner is me:
+                continue
+            if resource_id in owner.wants and (
+                owner.eating or not fork.dirty and owner.ticket < me.ticket
+            ):
+                if me not in fork.requests:
+                    fork.requests.append(me)
+                has_all = False
+                continue
+            fork.owner = me
+            fork.dirty = False
+            if owner.ticket is not None:
+                # It may have been counting on that fork; let it ask again
+                owner.wakeup.notify()
+        return has_all
+
+    def unlock_all(self, resource_ids):
+        with self.lock:
+            me = self.diner()
+            me.eating = False
+            me.ticket = None
+            me.wants = ()
+            for resource_id in resource_ids:
+                fork = self.forks[resource_id]
+                fork.dirty = True
+                waiting = [
+                    diner
+                    for diner in fork.requests
+                    if diner.ticket is not None and resource_id in diner.wants
+                ]
+                if waiting:
+                    next_owner = min(waiting, key=lambda diner: diner.ticket)
+                    waiting.remove(next_owner)
+                    fork.owner = next_owner
+                    fork.dirty = False
+                    next_owner.wakeup.notify()
+                fork.requests = waiting
+
+
+class Strategy(Enum):
+    ORDERED = "ordered"
+    ADMISSION = "admission"
+    CHANDY_MISRA = "chandy-misra"
+
+
+LOCK_MANAGERS = {
+    Strategy.ORDERED: OrderedLockManager,
+    Strategy.ADMISSION: AdmissionLockManager,
+    Strategy.CHANDY_MISRA: ChandyMisraLockManager,
+}
+
+
+def lock_manager(strategy=Strategy.ORDERED, **kwargs):
+    return LOCK_MANAGERS[strategy](**kwargs)
+
+
+class DiningPhilosophersLockManager(DiningPhilosophers):
+    """Solution to dining philosophers problem that asks a LockManager for both forks at once."""
+
+    def __init__(self, strategy=Strategy.CHANDY_MISRA):
+        self.forks = lock_manager(strategy)
+        self.exit = False
+
+    def attempt_eat(self, philosopher_id):
+        with self.forks.acquire_all({philosopher_id, (philosopher_id - 1) % 5}):
+            self.eat()
+
+
 PHILOSOPHERS = [
     "Aristotle",
     "Descartes",
@@ -96,6 +302,57 @@ def test_problem(problem):
         thread.join()
 
 
+def transactions(manager, n_threads, n_resources, hot_fraction, duration_s, per_tx=4, hold_s=0.0001):
+    """Each thread repeatedly locks per_tx resources drawn from the hottest
+    hot_fraction of n_resources, holds them for hold_s, and lets them go.
+
+    Returns transactions per second and each thread's transaction count.
+    """
+    hot = range(max(per_tx, int(n_resources * hot_fraction)))
+    counts = [0] * n_threads
+    # Nobody starts until every thread exists, or the first few get a head start
+    go = Event()
+
+    def worker(i):
+        go.wait()
+        while time.perf_counter() < deadline:
+            with manager.acquire_all(random.sample(hot, per_tx)):
+                time.sleep(hold_s)
+            counts[i] += 1
+
+    threads = [Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    deadline = start + duration_s
+    go.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start), counts
+
+
+def bench(duration_s=0.5):
+    # Transactions lock 4 resources each, drawn from all of them, the hottest
+    # tenth, or the hottest hundredth
+    for n_resources in (10, 100, 1000, 10_000):
+        for n_threads in (4, 16, 64, 256):
+            for hot_fraction in (1, 0.1, 0.01):
+                results = []
+                for strategy in Strategy:
+                    rate, counts = transactions(
+                        lock_manager(strategy), n_threads, n_resources, hot_fraction, duration_s
+                    )
+                    results.append(f"{strategy.value} {rate:>7,.0f} tx/s jain={jain_index(counts):.2f}")
+                print(
+                    f"resources={n_resources:<6} threads={n_threads:<3} hot={hot_fraction:<4} "
+                    + "  ".join(results)
+                )
+
+
 if __name__ == "__main__":
-    test_problem(DiningPhilosophersEatingSemaphore())
-    test_problem(DiningPhilosophersLeftHanded())
+    if sys.argv[1:] == ["bench"]:
+        bench()
+    else:
+        test_problem(DiningPhilosophersEatingSemaphore())
+        test_problem(DiningPhilosophersLeftHanded())
+        test_problem(DiningPhilosophersLockManager())
@@ -0,0 +1,284 @@
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+from collections import defaultdict
+from struct import Struct
+from threading import Event, Lock, Thread
+
+from chat_protocol import HEADER as FRAME_HEADER
+from chat_protocol import OP_TELL, frame
+
+# Every record is a header (state, recipient length, frame length), the
+# recipient's name, and the text frame exactly as it will be delivered.
+HEADER = Struct("!BHI")
+# A zero state marks where a segment's records end: new files are all zeroes
+END, LIVE, DELIVERED = range(3)
+
+
+class Segment:
+    def __init__(self, path, number, size):
+        self.path = path
+        self.number = number
+        exists = os.path.exists(path)
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.view = memoryview(self.map)
+        self.used = 0
+        self.live = 0
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+
+class Backlog(bytes):
+    """A chunk of replayed frames whose records stay live until it's handed to delivered()."""
+
+
+class MessageLog:
+    """Append-only store for messages whose recipient is offline.
+
+    Messages go into fixed-size memory-mapped segment files under directory,
+    and an in-memory index keeps each recipient's record positions as one
+    array of integers. replay() streams a recipient's backlog straight out of
+    the mapped pages; once a chunk has been written out, delivered() marks its
+    records in place, and requeue() puts back any that never made it. A
+    background thread deletes segments once every record in them has been
+    delivered.
+    Reopening a directory rebuilds the index from the records still live, so
+    segment_size must not change between runs.
+    """
+
+    def __init__(self, directory, segment_size=64 << 20, compact_interval_s=1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = Lock()
+        self.index = defaultdict(lambda: array("Q"))
+        self.segments = {}
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("segment-") and name.endswith(".log"):
+                self.recover(int(name[len("segment-") : -len(".log")]))
+        last = max(self.segments, default=-1)
+        self.active = self.segments[last] if last >= 0 else self.open_segment(0)
+        self.stopped = Event()
+        if compact_interval_s:
+            Thread(
+                target=self.run_compactor, args=(compact_interval_s,), daemon=True
+            ).start()
+
+    def open_segment(self, number):
+        path = os.path.join(self.directory, f"segment-{number:08d}.log")
+        segment = self.segments[number] = Segment(path, number, self.segment_size)
+        return segment
+
+    def recover(self, number):
+        segment = self.open_segment(number)
+        base = number * self.segment_size
+        offset = 0
+        while offset + HEADER.size <= self.segment_size:
+            state, recipient_len, frame_len = HEADER.unpack_from(segment.map, offset)
+            if state == END:
+                break
+            if state == LIVE:
+                start = offset + HEADER.size
+                recipient = bytes(segment.view[start : start + recipient_len]).decode()
+                self.index[recipient].append(base + offset)
+                segment.live += 1
+            offset += HEADER.size + recipient_len + frame_len
+        segment.used = offset
+
+    def append(self, recipient, sender, body):
+        recipient_bytes = recipient.encode()
+        data = frame(f"{sender}: {body}")
+        size = HEADER.size + len(recipient_bytes) + len(data)
+        if size > self.segment_size:
+            raise ValueError(f"a {size} byte record won't fit a {self.segment_size} byte segment")
+        with self.lock:
+            segment = self.active
+            if segment.used + size > self.segment_size:
+                segment = self.active = self.open_segment(segment.number + 1)
+            offset = segment.used
+            start = offset + HEADER.size
+            segment.map[start : start + len(recipient_bytes)] = recipient_bytes
+            segment.map[start + len(recipient_bytes) : offset + size] = data
+            # The header goes in last, so a scan never runs into a half-written record
+            HEADER.pack_into(segment.map, offset, LIVE, len(recipient_bytes), len(data))
+            segment.used += size
+            segment.live += 1
+            self.index[recipient].append(segment.number * self.segment_size + offset)
+
+    def pending(self, recipient):
+        with self.lock:
+            return len(self.index.get(recipient, ()))
+
+    def __len__(self):
+        with self.lock:
+            return sum(segment.live for segment in self.segments.values())
+
+    def replay(self, recipient, binary=False, chunk_bytes=64 * 1024):
+        """Yields recipient's backlog, oldest first, as chunks of ready-to-send frames.
+
+        Text clients get the frames as they were stored. Binary clients get
+        ID-0 tells whose payload is the same "sender: body" text, since the
+        sender may never have had an ID. Each chunk is a Backlog, and its
+        records are out of the index but still live until the caller passes
+        it to delivered() or requeue(). The backlog is taken out of the index
+        by the call itself rather than the first chunk, so a caller can pair
+        it with registering recipient under one lock. If the generator is
+        abandoned part way, the rest go back to the front of the recipient's
+        backlog.
+        """
+        with self.lock:
+            positions = self.index.pop(recipient, array("Q"))
+        return self.stream(recipient, positions, binary, chunk_bytes)
+
+    def stream(self, recipient, positions, binary, chunk_bytes):
+        i = 0
+        try:
+            while i < len(positions):
+                first = i
+                # The lock is only held while a chunk is copied out, so appends
+                # and compaction carry on between chunks
+                with self.lock:
+                    parts = []
+                    size = 0
+                    while i < len(positions) and size < chunk_bytes:
+                        number, offset = divmod(positions[i], self.segment_size)
+                        segment = self.segments[number]
+                        _, recipient_len, frame_len = HEADER.unpack_from(segment.map, offset)
+                        start = offset + HEADER.size + recipient_len
+                        data = segment.view[start : start + frame_len]
+                        if binary:
+                            # Binary frames carry a length instead of the newline
+                            parts.append(FRAME_HEADER.pack(OP_TELL, 0, frame_len - 1))
+                            data = data[:-1]
+                        parts.append(data)
+                        size += frame_len
+                        i += 1
+                    chunk = Backlog(b"".join(parts))
+                    del parts, data
+                chunk.recipient = recipient
+                chunk.positions = positions[first:i]
+                yield chunk
+        finally:
+            if i < len(positions):
+                with self.lock:
+                    self.restore(recipient, positions[i:])
+
+    def delivered(self, items):
+        """Marks the records behind every Backlog among items as delivered."""
+        chunks = [item for item in items if type(item) is Backlog]
+        if not chunks:
+            return
+        with self.lock:
+            for chunk in chunks:
+                for position in chunk.positions:
+                    number, offset = divmod(position, self.segment_size)
+                    segment = self.segments[number]
+                    segment.map[offset] = DELIVERED
+                    segment.live -= 1
+
+    def requeue(self, items):
+        """Puts the records behind every Backlog among items back in their recipients' backlogs."""
+        chunks = [item for item in items if type(item) is Backlog]
+        if not chunks:
+            return
+        with self.lock:
+            for chunk in chunks:
+                self.restore(chunk.recipient, chunk.positions)
+
+    def restore(self, recipient, positions):
+        # Positions only ever grow as records are appended, so sorting puts
+        # the returned ones back in the order they were sent
+        positions.extend(self.index.pop(recipient, ()))
+        self.index[recipient] = array("Q", sorted(positions))
+
+    def compact(self):
+        """Deletes every segment but the active one whose records have all been delivered."""
+        with self.lock:
+            done = [
+                segment
+                for segment in self.segments.values()
+                if segment is not self.active and segment.live == 0
+            ]
+            for segment in done:
+                del self.segments[segment.number]
+                segment.close()
+                os.unlink(segment.path)
+        return len(done)
+
+    def run_compactor(self, interval_s):
+        while not self.stopped.wait(interval_s):
+            self.compact()
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments.clear()
+
+
+def bench(n_msgs=1_000_000, n_recipients=(1, 1000), body="Call me, maybe?"):
+    for recipients in n_recipients:
+        directory = tempfile.mkdtemp(prefix="message-log-")
+        log = MessageLog(directory, segment_size=16 << 20, compact_interval_s=None)
+        names = [f"user-{i}" for i in range(recipients)]
+        start = time.perf_counter()
+        for i in range(n_msgs):
+            log.append(names[i % recipients], "sender", body)
+        append_s = time.perf_counter() - start
+        n_segments = len(log.segments)
+
+        start = time.perf_counter()
+        replayed = 0
+        for name in names:
+            for chunk in log.replay(name):
+                replayed += chunk.count(b"\n")
+                log.delivered((chunk,))
+        replay_s = time.perf_counter() - start
+        start = time.perf_counter()
+        deleted = log.compact()
+        compact_s = time.perf_counter() - start
+
+        log.close()
+        shutil.rmtree(directory)
+        print(
+            f"{n_msgs:,} msgs to {recipients:>4} recipients: append {n_msgs / append_s:>9,.0f} msgs/s, "
+            f"replay {replayed:,} in {replay_s:.2f}s ({replayed / replay_s:>10,.0f} msgs/s), "
+            f"compacted {deleted}/{n_segments} segments in {compact_s * 1000:.1f}ms"
+        )
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix="message-log-")
+    log = MessageLog(directory, segment_size=1024)
+    for i in range(200):
+        log.append("Alex" if i < 100 else "Karl", "Spot", f"message {i}")
+    print(f"{len(log)} messages pending across {len(log.segments)} segments")
+    chunks = list(log.replay("Alex"))
+    log.delivered(chunks)
+    print(b"".join(chunks).decode().splitlines()[:3], "...")
+    time.sleep(1.5)
+    print(f"{len(log)} pending across {len(log.segments)} segments after compaction")
+    log.close()
+    # Reopening finds Karl's messages still waiting
+    log = MessageLog(directory, segment_size=1024)
+    print(f"reopened: {log.pending('Karl')} pending for Karl")
+    log.close()
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bench"]:
+        bench()
+    else:
+        main()